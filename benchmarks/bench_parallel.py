@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""bench_parallel.py
+
+Description: Time reading a whole synthetic timelog into an ActivityTable
+with 1, 2, 4, ... parsing processes, to show how read_table scales across
+cores.
+
+"""
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tracktime import tracktime  # noqa: E402
+from generate_timelog import FIRST_DAY, write_timelog  # noqa: E402
+
+
+def job_counts(most):
+    """ 1, 2, 4, ... up to and including most """
+    counts = [1]
+    while counts[-1] * 2 < most:
+        counts.append(counts[-1] * 2)
+    if most > 1:
+        counts.append(most)
+    return counts
+
+
+def bench(path, jobs, repeat=3):
+    """ best seconds to read all of path with each number of jobs, and the
+    number of rows read """
+    timings = {}
+    rows = None
+    for count in jobs:
+        best = None
+        for ii in range(repeat):
+            begin = timeit.default_timer()
+            table = tracktime.get_table(
+              tracktime.FIRST_DAY, tracktime.LAST_DAY, path, count)
+            elapsed = timeit.default_timer() - begin
+            if best is None or elapsed < best:
+                best = elapsed
+        timings[count] = best
+        rows = len(table)
+    return timings, rows
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    p.add_argument(
+      '--days', type=int, default=125000,
+      help='days of synthetic timelog (125000 is about a million lines)')
+    p.add_argument(
+      '--jobs', type=int, default=multiprocessing.cpu_count(),
+      help='most parsing processes to try')
+    p.add_argument(
+      '--timelog', default=None,
+      help='time this timelog instead of generating one')
+    args = p.parse_args()
+    directory = tempfile.mkdtemp()
+    try:
+        path = args.timelog
+        if path is None:
+            path = os.path.join(directory, "timelog.txt")
+            count = write_timelog(path, FIRST_DAY, args.days)
+            print("generated %d lines" % (count, ))
+        (timings, rows) = bench(path, job_counts(args.jobs))
+    finally:
+        shutil.rmtree(directory)
+    print("read %d rows" % (rows, ))
+    print("%6s %12s %8s" % ("jobs", "seconds", "speedup"))
+    for count in sorted(timings.keys()):
+        print("%6d %12.3f %7.2fx" % (
+          count, timings[count], timings[1] / timings[count]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""bench_parse_line.py
+
+Description: Compare lines/sec of the fixed-layout and tolerant parsers
+on a synthetic multi-year timelog.
+
+"""
+from __future__ import print_function
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tracktime import tracktime  # noqa: E402
+from generate_timelog import write_timelog  # noqa: E402
+
+
+def lines_per_second(parse, lines, repeat=3):
+    """ best lines/sec of parse over lines """
+    def run():
+        for line in lines:
+            parse(line)
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+    return len(lines) / best
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    p.add_argument(
+      '--years', type=int, default=5, help='years of synthetic timelog')
+    args = p.parse_args()
+    path = os.path.join(tempfile.mkdtemp(), "timelog.txt")
+    write_timelog(path, datetime.datetime(2000, 1, 1), 365 * args.years)
+    with open(path) as fdin:
+        lines = fdin.readlines()
+    os.remove(path)
+    before = lines_per_second(tracktime.parse_tolerant_line, lines)
+    after = lines_per_second(tracktime.parse_line, lines)
+    print("%d lines (%d years)" % (len(lines), args.years))
+    print("%-24s %12.0f lines/sec" % ("parse_tolerant_line", before))
+    print("%-24s %12.0f lines/sec" % ("parse_line", after))
+    print("%-24s %12.1fx" % ("speedup", after / before))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""bench_startup.py
+
+Description: Measure the cold start of the common tracktime commands with
+python -X importtime, and check that they do not import the modules only
+needed by the rest of the command line.
+
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from generate_timelog import FIRST_DAY, write_timelog  # noqa: E402
+
+SCRIPT = os.path.join(ROOT, "tracktime", "tracktime.py")
+HOT_COMMANDS = [["start", "benchmark@work"], ["stop"], ["list"]]
+COLD_MODULES = ["argparse", "sqlite3", "json", "contextlib"]
+
+
+def run_importtime(argv, timelog):
+    """ Run the tracktime script with argv under -X importtime.  Returns
+    (wall seconds, import microseconds, names of the imported modules). """
+    env = dict(os.environ, TRACKTIME_TIMELOG=timelog)
+    begin = timeit.default_timer()
+    process = subprocess.Popen(
+      [sys.executable, "-X", "importtime", SCRIPT] + argv, env=env,
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (out, err) = process.communicate()
+    elapsed = timeit.default_timer() - begin
+    if process.returncode != 0:
+        raise RuntimeError(err.decode("utf-8", "replace"))
+    modules = []
+    total = 0
+    for line in err.decode("utf-8", "replace").splitlines():
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue  # not an import, or the header line
+        modules.append(fields[2].strip())
+        if fields[2][:2] != "  ":  # only count top level imports
+            total += int(fields[1])
+    return elapsed, total, modules
+
+
+def bench(days=365, repeat=5):
+    """ Best wall time and import time of each hot command on a timelog of
+    days days.  Returns (timings, problems) where problems names any cold
+    module imported by a hot command. """
+    directory = tempfile.mkdtemp()
+    timelog = os.path.join(directory, "timelog.txt")
+    write_timelog(timelog, FIRST_DAY, days)
+    timings = {}
+    problems = []
+    try:
+        for argv in HOT_COMMANDS:
+            name = "startup/%s" % ("_".join(argv[:1]), )
+            best = None
+            for ii in range(repeat):
+                (elapsed, imports, modules) = run_importtime(argv, timelog)
+                if best is None or elapsed < best[0]:
+                    best = (elapsed, imports)
+            timings[name] = best[0]
+            timings[name + "_imports"] = best[1] / 1e6
+            problems.extend(
+              "%s imports %s" % (" ".join(argv), module)
+              for module in COLD_MODULES if module in modules)
+    finally:
+        shutil.rmtree(directory)
+    return timings, problems
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    p.add_argument(
+      '--days', type=int, default=365, help='days of synthetic timelog')
+    args = p.parse_args()
+    (timings, problems) = bench(args.days)
+    for name in sorted(timings.keys()):
+        print("%-28s %10.2f ms" % (name, timings[name] * 1000))
+    for problem in problems:
+        print("FAILED: %s" % (problem, ))
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
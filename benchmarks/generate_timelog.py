@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""generate_timelog.py
+
+Description: Write a synthetic timelog for benchmarking tracktime.
+
+"""
+from __future__ import print_function
+import argparse
+import datetime
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tracktime import tracktime  # noqa: E402
+
+NAMES = [
+  "admin", "email", "standup", "code review", "design", "lunch", "travel",
+  "support", "planning", "reading"]
+CATEGORIES = ["work", "break", "general", "client x", "Tiny Office"]
+FIRST_DAY = datetime.datetime(2000, 1, 1)
+
+
+def generate_lines(
+  first_day, days, seed=0, min_per_day=4, max_per_day=12, comment_rate=0.0,
+  open_rate=0.0, open_last=False):
+    """ Yield timelog lines for each of days starting at first_day, in the
+    format written by Activity.__str__.  Each day has between min_per_day
+    and max_per_day activities, back to back from the morning.  A
+    comment_rate fraction of days get a comment line, an open_rate
+    fraction leave their last activity in progress, and open_last leaves
+    the very last activity in progress. """
+    rng = random.Random(seed)
+    for ii in range(days):
+        day = first_day + datetime.timedelta(days=ii)
+        if rng.random() < comment_rate:
+            yield "# %s" % (day.strftime(tracktime.DAYFORMAT), )
+        now = day + datetime.timedelta(
+          hours=rng.randint(6, 9), seconds=rng.randint(0, 3599))
+        count = rng.randint(min_per_day, max_per_day)
+        for jj in range(count):
+            endtime = now + datetime.timedelta(seconds=rng.randint(300, 5400))
+            last = jj == count - 1
+            if last and (
+              rng.random() < open_rate or open_last and ii == days - 1):
+                endtime = tracktime.INPROGRESS
+            yield str(tracktime.Activity(
+              now, rng.choice(NAMES), rng.choice(CATEGORIES), endtime))
+            now = endtime
+
+
+def write_timelog(path, first_day=FIRST_DAY, days=365, **options):
+    """ Write a synthetic timelog to path; returns the number of lines.
+    options are passed on to generate_lines. """
+    count = 0
+    with open(path, "w") as fdout:
+        for line in generate_lines(first_day, days, **options):
+            print(line, file=fdout)
+            count += 1
+    return count
+
+
+def make_parser():
+    p = argparse.ArgumentParser(
+      description='Write a synthetic timelog for benchmarks.')
+    p.add_argument('path', metavar='PATH', help='timelog to write')
+    p.add_argument(
+      '--days', type=int, default=365,
+      help='number of days to generate (1 to 7300 for 20 years)')
+    p.add_argument('--seed', type=int, default=0, help='random seed')
+    p.add_argument(
+      '--min-per-day', type=int, default=4, help='fewest activities a day')
+    p.add_argument(
+      '--max-per-day', type=int, default=12, help='most activities a day')
+    p.add_argument(
+      '--comment-rate', type=float, default=0.02,
+      help='fraction of days with a comment line')
+    p.add_argument(
+      '--open-rate', type=float, default=0.01,
+      help='fraction of days whose last activity is left in progress')
+    p.add_argument(
+      '--open-last', action='store_true',
+      help='leave the last activity in progress')
+    return p
+
+
+def main():
+    args = make_parser().parse_args()
+    count = write_timelog(
+      args.path, FIRST_DAY, args.days, seed=args.seed,
+      min_per_day=args.min_per_day, max_per_day=args.max_per_day,
+      comment_rate=args.comment_rate, open_rate=args.open_rate,
+      open_last=args.open_last)
+    print("wrote %d lines to %s" % (count, args.path))
+
+
+if __name__ == "__main__":
+    main()
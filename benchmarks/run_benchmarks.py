@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""run_benchmarks.py
+
+Description: Time the hot paths of tracktime on synthetic timelogs of
+several sizes, write the results as JSON and compare them with a stored
+baseline.  Exits with status 1 if any timing regressed.
+
+"""
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tracktime import tracktime  # noqa: E402
+from generate_timelog import FIRST_DAY, write_timelog  # noqa: E402
+import bench_startup  # noqa: E402
+
+BASELINE = os.path.join(
+  os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+SIZES = [1, 365, 7300]
+PARSE_LINES = 10000
+
+
+def best_time(run, setup=None, repeat=7, number=20):
+    """ Best wall time of one run() over repeat samples of number calls.
+    With a setup, every call is its own sample preceded by setup(). """
+    if setup is not None:
+        (repeat, number) = (repeat * number, 1)
+    best = None
+    for ii in range(repeat):
+        if setup is not None:
+            setup()
+        begin = timeit.default_timer()
+        for jj in range(number):
+            run()
+        elapsed = (timeit.default_timer() - begin) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def calibrate():
+    """ time a fixed pure Python workload, used to scale the baseline to
+    the speed of this machine """
+    def run():
+        total = 0
+        for ii in range(200000):
+            total += ii % 7
+        return total
+    return best_time(run, number=1)
+
+
+class Quiet(object):
+    """ send stdout to devnull while reports print """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def __exit__(self, *exc):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def bench_size(days, directory):
+    """ time every hot path on a timelog of days days """
+    timelog = os.path.join(directory, "timelog_%d.txt" % (days, ))
+    write_timelog(
+      timelog, FIRST_DAY, days, comment_rate=0.02, open_rate=0.01,
+      open_last=True)
+    last_day = FIRST_DAY + datetime.timedelta(days=days - 1)
+    middle_day = FIRST_DAY + datetime.timedelta(days=days // 2)
+    now = last_day + datetime.timedelta(hours=23)
+    with open(timelog) as fdin:
+        lines = fdin.readlines()[:PARSE_LINES]
+    results = {}
+
+    def parse():
+        for line in lines:
+            tracktime.parse_line(line)
+    results["parse_line"] = best_time(parse, number=1) / len(lines)
+    results["get_rows_no_index"] = best_time(
+      lambda: tracktime.get_rows(middle_day, timelog))
+    tracktime.build_day_index(timelog)
+    results["get_rows"] = best_time(
+      lambda: tracktime.get_rows(middle_day, timelog))
+    with Quiet():
+        results["list_day"] = best_time(
+          lambda: tracktime.list_day(last_day, now, timelog))
+        results["list_week"] = best_time(
+          lambda: tracktime.list_week(now, timelog))
+        results["list_year"] = best_time(
+          lambda: tracktime.list_range(
+            last_day - datetime.timedelta(days=364),
+            last_day + datetime.timedelta(days=1), now, timelog), number=3)
+        results["list_year_category"] = best_time(
+          lambda: tracktime.list_range(
+            last_day - datetime.timedelta(days=364),
+            last_day + datetime.timedelta(days=1), now, timelog,
+            category="client x"), number=3)
+    clock = [now]
+
+    def start():
+        clock[0] += datetime.timedelta(seconds=1)
+        tracktime.start(clock[0], "benchmark", "work", timelog)
+    results["start"] = best_time(start)
+    results["stop"] = best_time(
+      lambda: tracktime.stop(clock[0] + datetime.timedelta(seconds=1),
+                             timelog),
+      setup=start)
+    return dict(("%dd/%s" % (days, key), value)
+                for (key, value) in results.items())
+
+
+def run(sizes):
+    """ results of every benchmark, with the calibration time and any cold
+    modules imported by the hot commands """
+    directory = tempfile.mkdtemp()
+    timings = {}
+    try:
+        for days in sizes:
+            timings.update(bench_size(days, directory))
+    finally:
+        shutil.rmtree(directory)
+    (startup, problems) = bench_startup.bench()
+    timings.update(startup)
+    return {
+      "calibration": calibrate(),
+      "python": platform.python_version(),
+      "problems": problems,
+      "timings": timings,
+      }
+
+
+def compare(results, baseline, tolerance):
+    """ Print each timing against the baseline, scaled by the calibration
+    ratio of the two machines.  Returns the names that regressed by more
+    than tolerance times. """
+    scale = results["calibration"] / baseline["calibration"]
+    regressions = []
+    print("%-28s %12s %12s %8s" % ("benchmark", "baseline", "now", "ratio"))
+    for name in sorted(results["timings"].keys()):
+        now = results["timings"][name]
+        if name not in baseline["timings"]:
+            print("%-28s %12s %12.6f %8s" % (name, "-", now, "new"))
+            continue
+        expected = baseline["timings"][name] * scale
+        ratio = now / expected
+        flag = ""
+        if ratio > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("%-28s %12.6f %12.6f %7.2fx%s" % (
+          name, expected, now, ratio, flag))
+    return regressions
+
+
+def make_parser():
+    p = argparse.ArgumentParser(
+      description='Benchmark tracktime against a stored baseline.')
+    p.add_argument(
+      '--sizes', default=",".join(str(days) for days in SIZES),
+      help='comma separated timelog sizes, in days')
+    p.add_argument(
+      '--output', default=None, help='write the results as JSON here')
+    p.add_argument(
+      '--baseline', default=BASELINE, help='baseline JSON to compare with')
+    p.add_argument(
+      '--tolerance', type=float, default=2.0,
+      help='slowdown over the baseline that counts as a regression')
+    p.add_argument(
+      '--save-baseline', action='store_true',
+      help='store these results as the new baseline')
+    return p
+
+
+def main():
+    args = make_parser().parse_args()
+    sizes = [int(days) for days in args.sizes.split(",")]
+    results = run(sizes)
+    if args.output:
+        with open(args.output, "w") as fdout:
+            json.dump(results, fdout, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, "w") as fdout:
+            json.dump(results, fdout, indent=2, sort_keys=True)
+        print("saved baseline to %s" % (args.baseline, ))
+        return 0
+    with open(args.baseline) as fdin:
+        baseline = json.load(fdin)
+    regressions = compare(results, baseline, args.tolerance)
+    for problem in results["problems"]:
+        print("FAILED: %s" % (problem, ))
+    if results["problems"]:
+        return 1
+    if regressions:
+        print("FAILED: %d regressions: %s" % (
+          len(regressions), ", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
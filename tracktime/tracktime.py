@@ -8,27 +8,74 @@ Author: Andrew Mattheisen
 """
 from __future__ import print_function
 import datetime
-import argparse
-from sys import argv
-import fileinput
+import sys
+import os
 from os.path import expanduser
 from os.path import join as ospathjoin
 
 VERSION = "0.0"
-TIMELOG = ospathjoin(expanduser("~"), "timelog.txt")
+TIMELOG = os.environ.get(
+  "TRACKTIME_TIMELOG", ospathjoin(expanduser("~"), "timelog.txt"))
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+SOCKET_SUFFIX = ".sock"
+LOCK_SUFFIX = ".lock"
+SEGMENT_SUFFIX = ".txt"
+GZIP_SUFFIX = ".gz"
+SEGMENTS_SUFFIX = ".d"
+LOCKED_COMMANDS = ("start", "stop")
+HELD_LOCKS = {}
+VALID_PARTS = {}
+TRACE = None
+SERVED_COMMANDS = ("start", "stop", "list")
+SERVER_TIMEOUT = 2.0
+WATCH_INTERVAL = 2.0
+WATCH_CLEAR = "\033[H\033[2J"
 DATETIMEFORMAT = "%Y-%m-%dT%H:%M:%S"
 DAYFORMAT = "%Y-%m-%d"
 INPROGRESS = "none"
+INPROGRESS_KEY = INPROGRESS.encode("ascii")
 DEFAULT_CATEGORY = "general"
+DAY_INDEX_SUFFIX = ".idx"
+DAY_INDEX_HEADER = "SIZE=%020d; MTIME=%020.6f\n"
+DAY_INDEX_ENTRY = "DAY=%s; OFFSET=%020d\n"
+DAY_INDEX_HEADER_SIZE = len(DAY_INDEX_HEADER % (0, 0))
+DAY_INDEX_ENTRY_SIZE = len(DAY_INDEX_ENTRY % ("YYYY-MM-DD", 0))
+ROLLUP_SUFFIX = ".rollup"
+ROLLUP_HEADER = "SIZE=%020d; MTIME=%020.6f; OPENDAY=%s; OPENOFFSET=%020d\n"
+ROLLUP_ENTRY = "DAY=%s; SECONDS=%d; CATEGORY=%s\n"
+NO_DAY = "0000-00-00"
+TERMS_SUFFIX = ".terms"
+TERMS_HEADER = "SIZE=%020d; MTIME=%020.6f; POSTINGS=%020d; TAIL=%020d\n"
+TERMS_HEADER_SIZE = len(TERMS_HEADER % (0, 0, 0, 0))
+TERMS_ENTRY = "%s=%s; AT=%d; COUNT=%d\n"
+TERMS_POSTING = "%012d\n"
+TERMS_POSTING_SIZE = len(TERMS_POSTING % 0)
+TERMS_TAIL_ENTRY = "%s=%s; OFFSET=%d\n"
+TERMS_TAIL_LIMIT = 65536
+TERMS_FIELDS = ("CATEGORY", "NAME")
+GLOB_CHARACTERS = "*?["
+EPOCH = datetime.datetime(1970, 1, 1)
+NUMPY_MIN_ROWS = 100000
+INPROGRESS_EPOCH = -(2 ** 62)
+FIRST_DAY = datetime.datetime.min
+LAST_DAY = datetime.datetime.max
+EXPORT_FIELDS = ("starttime", "name", "category", "endtime")
+EXPORT_FORMATS = ("csv", "jsonl")
+TEXT_TYPES = (type(u""), type(""))
 ACTIVITY_DAY_HEADER = """= TRACKTIME REPORT FOR {weekday:<10} {day} =
  Start - End    (Duration) | Activity@Category
 ---------------------------+------------------"""
+RANGE_HEADER = "= TRACKTIME REPORT FROM {first} TO {last} ="
+INTERVALS_HEADER = "= TRACKTIME {title} ="
+TEAM_HEADER = "= TRACKTIME TEAM REPORT FROM {first} TO {last} ="
 
 
 # MODELS
-class Activity():
+class Activity(object):
     """ An Activity is a task (e.g. sweep floor) with a start datetime,
     category, and end datetime. """
+    __slots__ = ("starttime", "name", "category", "endtime")
+
     def __init__(
       self, starttime, name, category=DEFAULT_CATEGORY,
       endtime=False):
@@ -45,16 +92,14 @@ class Activity():
             return "STARTTIME=%s; NAME=%s; CATEGORY=%s; ENDTIME=%s" % (
               self.starttime.strftime(DATETIMEFORMAT), self.name,
               self.category, self.endtime.strftime(DATETIMEFORMAT))
-        except:  # endtime is not a datetime
+        except AttributeError:  # endtime is not a datetime
             return "STARTTIME=%s; NAME=%s; CATEGORY=%s; ENDTIME=%s" % (
               self.starttime.strftime(DATETIMEFORMAT), self.name,
               self.category, self.endtime)
 
     def writedb(self, timelog=TIMELOG):
         """ write activity to database """
-        fdout = open(timelog, "a")
-        print(self.__str__(), file=fdout)
-        fdout.close()
+        get_backend(timelog).append(self)
 
     def get_duration(self, now):
         """ compute the duration of activity """
@@ -91,57 +136,1016 @@ class Activity():
         return activity_text
 
 
+class ActivityTable(object):
+    """ Many activities held as columns of epoch times and ids into one shared
+    list of names and categories. """
+    def __init__(self, activities=()):
+        from array import array
+        try:
+            (self.starts, self.ends) = (array("q"), array("q"))
+        except ValueError:  # Python 2 has no long long arrays
+            (self.starts, self.ends) = (array("l"), array("l"))
+        self.name_ids = array("i")
+        self.category_ids = array("i")
+        self.strings = []
+        self.string_ids = {}
+        for activity in activities:
+            self.append(activity)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, ii):
+        return self.row(ii)
+
+    def __iter__(self):
+        for ii in range(len(self)):
+            yield self.row(ii)
+
+    def intern(self, text):
+        """ id of text in the string list, adding it if needed """
+        try:
+            return self.string_ids[text]
+        except KeyError:
+            self.string_ids[text] = len(self.strings)
+            self.strings.append(text)
+            return self.string_ids[text]
+
+    def append(self, activity):
+        """ add an activity as the last row """
+        self.starts.append(to_epoch(activity.starttime))
+        if activity.endtime == INPROGRESS:
+            self.ends.append(INPROGRESS_EPOCH)
+        else:
+            self.ends.append(to_epoch(activity.endtime))
+        self.name_ids.append(self.intern(activity.name))
+        self.category_ids.append(self.intern(activity.category))
+
+    def extend(self, table):
+        """ add the rows of another ActivityTable after these """
+        self.starts.extend(table.starts)
+        self.ends.extend(table.ends)
+        ids = [self.intern(text) for text in table.strings]
+        self.name_ids.extend(ids[ii] for ii in table.name_ids)
+        self.category_ids.extend(ids[ii] for ii in table.category_ids)
+
+    def row(self, ii):
+        """ build the Activity for row ii """
+        end = self.ends[ii]
+        return Activity(
+          from_epoch(self.starts[ii]), self.strings[self.name_ids[ii]],
+          self.strings[self.category_ids[ii]],
+          INPROGRESS if end == INPROGRESS_EPOCH else from_epoch(end))
+
+    def durations(self, now):
+        """ Yield the duration in seconds of each row, clipping activities
+        in progress the way Activity.get_duration does. """
+        now = to_epoch(now)
+        today = now - now % 86400
+        for (start, end) in zip(self.starts, self.ends):
+            if end != INPROGRESS_EPOCH:
+                yield end - start
+            elif start - start % 86400 != today:  # task is for prior day
+                yield start - start % 86400 + 86399 - start
+            else:  # Task is ongoing
+                yield now - start
+
+    def category_seconds(self, now):
+        """ Sum the seconds spent in each category id. """
+        seconds = {}
+        for (category_id, duration) in zip(
+          self.category_ids, self.durations(now)):
+            seconds[category_id] = seconds.get(category_id, 0) + duration
+        return seconds
+
+    def category_hours(self, now, category_hours=None):
+        """ Sum the hours by category as timedeltas. """
+        if category_hours is None:
+            category_hours = {}
+        for (category_id, seconds) in self.category_seconds(now).items():
+            add_duration(
+              category_hours, self.strings[category_id],
+              datetime.timedelta(seconds=seconds))
+        return category_hours
+
+    def day_category_seconds(self, now, first_day, days):
+        """ Sum the seconds by category on each of days days from first_day;
+        returns the categories and a row per day. """
+        if len(self) < NUMPY_MIN_ROWS and "numpy" not in sys.modules:
+            return self.day_category_seconds_array(now, first_day, days)
+        try:
+            import numpy
+        except ImportError:
+            return self.day_category_seconds_array(now, first_day, days)
+        now = to_epoch(now)
+        starts = numpy.asarray(self.starts, dtype=numpy.int64)
+        ends = numpy.asarray(self.ends, dtype=numpy.int64)
+        start_days = starts - starts % 86400
+        durations = numpy.where(
+          ends != INPROGRESS_EPOCH, ends - starts, numpy.where(
+            start_days != now - now % 86400, start_days + 86399 - starts,
+            now - starts))
+        day_numbers = (start_days - to_epoch(first_day)) // 86400
+        inside = (day_numbers >= 0) & (day_numbers < days)
+        (category_ids, columns) = numpy.unique(
+          numpy.asarray(self.category_ids, dtype=numpy.int64)[inside],
+          return_inverse=True)
+        cells = numpy.bincount(
+          day_numbers[inside] * len(category_ids) + columns.ravel(),
+          weights=durations[inside], minlength=days * len(category_ids))
+        rows = cells.reshape(days, len(category_ids)).astype(numpy.int64)
+        return [self.strings[ii] for ii in category_ids], rows.tolist()
+
+    def day_category_seconds_array(self, now, first_day, days):
+        """ day_category_seconds without NumPy """
+        first = to_epoch(first_day)
+        (columns, cells) = ({}, {})
+        for (start, category_id, duration) in zip(
+          self.starts, self.category_ids, self.durations(now)):
+            day = (start - first) // 86400
+            if 0 <= day < days:
+                column = columns.setdefault(category_id, len(columns))
+                cells[day, column] = cells.get((day, column), 0) + duration
+        rows = [[0] * len(columns) for ii in range(days)]
+        for ((day, column), seconds) in cells.items():
+            rows[day][column] = seconds
+        categories = [None] * len(columns)
+        for (category_id, column) in columns.items():
+            categories[column] = self.strings[category_id]
+        return categories, rows
+
+
+class IntervalIndex(object):
+    """ A centered interval tree over the rows of an ActivityTable. """
+    def __init__(self, table, now):
+        self.table = table
+        spans = [
+          (start, start + duration, row) for (row, (start, duration)) in
+          enumerate(zip(table.starts, table.durations(now))) if duration > 0]
+        spans.sort()
+        self.spans = spans
+        self.starts = [span[0] for span in spans]
+        self.root = self.build(spans)
+
+    def build(self, spans):
+        """ tree node (center, by_start, by_end, left, right) for spans sorted
+        by start, or None """
+        if not spans:
+            return None
+        center = spans[len(spans) // 2][0]
+        (left, here, right) = ([], [], [])
+        for span in spans:
+            if span[1] <= center:
+                left.append(span)
+            elif span[0] > center:
+                right.append(span)
+            else:
+                here.append(span)
+        by_end = sorted(here, key=lambda span: -span[1])
+        return (center, here, by_end, self.build(left), self.build(right))
+
+    def at(self, moment):
+        """ rows in progress at moment, in start time order """
+        when = to_epoch(moment)
+        spans = []
+        node = self.root
+        while node is not None:
+            (center, by_start, by_end, left, right) = node
+            if when < center:
+                for span in by_start:
+                    if span[0] > when:
+                        break
+                    spans.append(span)
+                node = left
+            else:
+                for span in by_end:
+                    if span[1] <= when:
+                        break
+                    spans.append(span)
+                node = right
+        return [span[2] for span in sorted(spans)]
+
+    def overlaps(self, first, end):
+        """ rows in progress at any time from first up to end, in start time
+        order """
+        from bisect import bisect_left, bisect_right
+        low = bisect_right(self.starts, to_epoch(first))
+        high = bisect_left(self.starts, to_epoch(end))
+        return self.at(first) + [span[2] for span in self.spans[low:high]]
+
+    def overlapping(self):
+        """ the set of rows that overlap another row; their time is counted
+        twice in the totals """
+        rows = set()
+        (latest_end, latest_row) = (None, None)
+        for (start, end, row) in self.spans:
+            if latest_end is not None and start < latest_end:
+                rows.update((row, latest_row))
+            if latest_end is None or end > latest_end:
+                (latest_end, latest_row) = (end, row)
+        return rows
+
+
+# STORAGE
+def get_backend(timelog=TIMELOG):
+    """ storage backend for timelog, chosen by its file extension; a directory
+    holds monthly segments """
+    if hasattr(timelog, "iter_rows"):
+        return timelog
+    if timelog.lower().endswith(SQLITE_SUFFIXES):
+        return SQLiteBackend(timelog)
+    if os.path.isdir(timelog):
+        return SegmentedBackend(timelog)
+    return TextBackend(timelog)
+
+
+class Backend(object):
+    """ Reports a backend makes from its own category_hours and rows """
+    def sum_days(self, days, now, category_hours=None):
+        """ Sum the hours by category over days. """
+        if category_hours is None:
+            category_hours = {}
+        for day in days:
+            self.category_hours(
+              day, day + datetime.timedelta(days=1), now, category_hours)
+        return category_hours
+
+    def day_seconds(
+      self, first_day, end_day, now, jobs=1, category=None, name=None):
+        """ (categories, rows) of the seconds by category on each day from
+        first_day up to end_day """
+        return table_day_seconds(
+          first_day, end_day, now, self, jobs, category, name)
+
+
+class TextBackend(Backend):
+    """ Activities stored one per line in a flat text file, appended in
+    time order and located by the sidecar day index. """
+    def __init__(self, timelog=TIMELOG):
+        self.timelog = timelog
+
+    def append(self, activity):
+        """ append one activity to the timelog """
+        with TimelogLock(self.timelog):
+            try:
+                old_stat = os.stat(self.timelog)
+            except OSError:  # new timelog
+                old_stat = None
+            fdout = open(self.timelog, "ab")
+            trace_count("files opened")
+            fdout.write(record_bytes(activity) + b"\n")
+            fdout.close()
+            extend_day_index(activity.starttime, old_stat, self.timelog)
+            extend_rollup(activity.starttime, old_stat, self.timelog)
+            extend_terms(activity, old_stat, self.timelog)
+
+    def extend(self, activities):
+        """ append many activities with one buffered write; returns the number
+        written """
+        count = 0
+        with TimelogLock(self.timelog):
+            with open(self.timelog, "ab") as fdout:
+                for activity in activities:
+                    fdout.write(record_bytes(activity) + b"\n")
+                    count += 1
+        return count
+
+    def iter_rows(self, first_day, end_day, category=None, name=None):
+        """ Generate rows from first_day up to end_day whose category and name
+        match the glob patterns, reading from the day index offset on. """
+        try:
+            offset = find_day_offset(first_day, self.timelog)
+            offsets = term_offsets(
+              category, name, self.timelog, offset, self.end_offset(
+                end_day) if category or name else None)
+            fdin = open(self.timelog, "rb")
+        except (IOError, OSError):  # file does not exist, nothing to list
+            return
+        trace_count("files opened")
+        with fdin:
+            if offsets is None:
+                rows = self.read_lines(
+                  fdin, offset, first_day, end_day, category, name)
+            else:
+                rows = self.read_offsets(fdin, offsets, offset, end_day)
+            for activity in rows:
+                if matches(activity, category, name):
+                    yield activity
+
+    def end_offset(self, end_day):
+        """ offset of the first activity on or after end_day if it is a
+        day, or None to read to the end """
+        if end_day >= LAST_DAY or not datetime_key(end_day).endswith(
+          "00:00:00"):
+            return None
+        return find_day_offset(end_day, self.timelog)
+
+    def read_lines(
+      self, fdin, offset, first_day, end_day, category=None, name=None):
+        """ Generate the activities of an open binary timelog from offset on
+        that start from first_day up to end_day. """
+        end_key = datetime_key(end_day)
+        (category_text, name_text) = (
+          glob_literal(category), glob_literal(name))
+        parse = traced(parse_line, "parse", "lines parsed", "lines skipped")
+        fdin.seek(offset)
+        read = 0
+        try:
+            for line in fdin:
+                read += len(line)
+                line = line.decode("utf-8")
+                if line[:10] == "STARTTIME=" and line[10:29] >= end_key:
+                    break
+                if category_text not in line or name_text not in line:
+                    continue
+                activity = parse(line, self.timelog)
+                if not activity or activity.starttime < first_day:
+                    continue
+                if activity.starttime >= end_day:
+                    break
+                yield activity
+        finally:
+            trace_count("bytes read", read)
+
+    def read_offsets(self, fdin, offsets, first_offset, end_day):
+        """ Generate the activities of an open binary timelog at offsets from
+        first_offset on, up to end_day. """
+        from bisect import bisect_left
+        parse = traced(parse_line, "parse", "lines parsed", "lines skipped")
+        for offset in offsets[bisect_left(offsets, first_offset):]:
+            fdin.seek(offset)
+            line = fdin.readline()
+            trace_count("bytes read", len(line))
+            activity = parse(line.decode("utf-8"), self.timelog)
+            if not activity:
+                continue
+            if activity.starttime >= end_day:
+                break
+            yield activity
+
+    def last(self):
+        """ the last activity, or None if there is none """
+        try:
+            fdin = open(self.timelog, "rb")
+        except IOError:  # timelog does not exist
+            return None
+        with fdin:
+            (offset, line) = find_last_record(fdin)
+        if line is None:
+            return None
+        return parse_line(line.decode("utf-8"), self.timelog)
+
+    def stop(self, now):
+        """ stop the activity in progress, if it was started today """
+        with TimelogLock(self.timelog):
+            self.stop_locked(now)
+
+    def stop_locked(self, now):
+        """ stop, with the timelog lock held """
+        today = datetime.datetime(now.year, now.month, now.day)
+        try:
+            old_stat = os.stat(self.timelog)
+            fdlog = open(self.timelog, "r+b")
+        except (IOError, OSError):  # timelog does not exist, nothing to stop
+            return
+        trace_count("files opened")
+        with fdlog:
+            # Only the last activity in the timelog can be in progress
+            (offset, line) = find_last_record(fdlog)
+            try:
+                activity = parse_line(line.decode("utf-8"), self.timelog)
+            except (AttributeError, ValueError):  # no activity to stop
+                return
+            if activity.starttime < today or activity.endtime != INPROGRESS:
+                return
+            # stop activity, rewriting only its line and anything after it
+            activity.endtime = now
+            newline = line[len(line.rstrip(b"\r\n")):]
+            fdlog.seek(offset + len(line))
+            trailer = fdlog.read()
+            fdlog.seek(offset)
+            fdlog.write(record_bytes(activity) + newline + trailer)
+        trace_count("stop rewrites")
+        trace_count("stop bytes rewritten", len(line) + len(trailer))
+        # only the open day changed, so this marks the sidecars as current
+        extend_day_index(activity.starttime, old_stat, self.timelog)
+        extend_rollup(activity.starttime, old_stat, self.timelog)
+        extend_terms(None, old_stat, self.timelog)
+
+    def category_hours(self, first_day, end_day, now, category_hours=None):
+        """ Sum the hours by category for activities started on or after
+        first_day and before end_day. """
+        table = get_table(first_day, end_day, self.timelog)
+        return table.category_hours(now, category_hours)
+
+    def sum_days(self, days, now, category_hours=None):
+        """ Sum the hours by category over days, from the rollup cache for
+        closed days. """
+        if category_hours is None:
+            category_hours = {}
+        if not days:
+            return category_hours
+        (entries, cutoff) = self.closed_days(
+          min(days), max(days) + datetime.timedelta(days=1), now)
+        wanted = set(datetime_key(day)[:len(NO_DAY)] for day in days)
+        for (day, category, seconds) in entries:
+            if day in wanted:
+                add_duration(category_hours, category, datetime.timedelta(
+                  seconds=seconds))
+        live_days = [day for day in days if day >= cutoff]
+        buckets = bucket_rows(live_days, self.timelog)
+        for day in live_days:
+            add_category_hours(buckets[day], now, category_hours)
+        return category_hours
+
+    def day_seconds(
+      self, first_day, end_day, now, jobs=1, category=None, name=None):
+        """ (categories, rows) as Backend.day_seconds, from the rollup cache
+        for closed days unless filtered by name """
+        if name is not None:
+            return table_day_seconds(
+              first_day, end_day, now, self.timelog, jobs, category, name)
+        (entries, cutoff) = self.closed_days(first_day, end_day, now)
+        cutoff = max(cutoff, first_day)
+        table = get_table(cutoff, end_day, self.timelog, jobs, category)
+        (categories, rows) = table.day_category_seconds(
+          now, first_day, (end_day - first_day).days)
+        add_rollup_seconds(categories, rows, entries, first_day, category)
+        return categories, rows
+
+    def closed_days(self, first_day, end_day, now):
+        """ rollup cache entries of the closed days from first_day up to
+        end_day, and the first day that is not closed """
+        try:
+            (entries, open_day) = get_rollup(first_day, end_day, self.timelog)
+        except (IOError, OSError, ValueError):  # no timelog or malformed
+            (entries, open_day) = ([], FIRST_DAY)
+        cutoff = min(datetime.datetime(now.year, now.month, now.day), open_day)
+        key = datetime_key(cutoff)[:len(NO_DAY)]
+        return [entry for entry in entries if entry[0] < key], cutoff
+
+
+class SQLiteBackend(Backend):
+    """ Activities stored in an SQLite database, times as epoch seconds. """
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS activity (
+  id INTEGER PRIMARY KEY,
+  starttime INTEGER NOT NULL,
+  name TEXT NOT NULL,
+  category TEXT NOT NULL,
+  endtime INTEGER);
+CREATE INDEX IF NOT EXISTS activity_starttime ON activity (starttime);
+CREATE INDEX IF NOT EXISTS activity_category ON activity (
+  category, starttime);
+CREATE INDEX IF NOT EXISTS activity_inprogress ON activity (starttime)
+  WHERE endtime IS NULL;
+"""
+    INSERT = """INSERT INTO activity (starttime, name, category, endtime)
+  VALUES (?, ?, ?, ?)"""
+    SELECT = """SELECT starttime, name, category, endtime FROM activity
+  WHERE starttime >= :first AND starttime < :end
+    AND (:category IS NULL OR category GLOB :category)
+    AND (:name IS NULL OR name GLOB :name)
+  ORDER BY starttime, id"""
+    LAST = """SELECT starttime, name, category, endtime FROM activity
+  ORDER BY starttime DESC, id DESC LIMIT 1"""
+    STOP = """UPDATE activity SET endtime = ?
+  WHERE endtime IS NULL AND starttime >= ?"""
+    CATEGORY_SECONDS = """SELECT category, SUM(CASE
+    WHEN endtime IS NOT NULL THEN endtime - starttime
+    WHEN starttime - starttime % 86400 != :today
+      THEN starttime - starttime % 86400 + 86399 - starttime
+    ELSE :now - starttime END)
+  FROM activity WHERE starttime >= :first AND starttime < :end
+  GROUP BY category"""
+
+    def __init__(self, timelog):
+        self.timelog = timelog
+
+    def connect(self):
+        """ open the database, creating its schema if needed """
+        import sqlite3
+        connection = sqlite3.connect(self.timelog)
+        trace_count("files opened")
+        connection.executescript(self.SCHEMA)
+        return connection
+
+    def session(self):
+        """ context manager that connects and then closes the connection """
+        from contextlib import closing
+        return closing(self.connect())
+
+    def append(self, activity):
+        """ insert one activity """
+        self.extend([activity])
+
+    def extend(self, activities):
+        """ insert many activities in one transaction; returns the number
+        inserted. """
+        rows = (self.to_row(activity) for activity in activities)
+        with self.session() as connection:
+            with connection:
+                cursor = connection.executemany(self.INSERT, rows)
+        return cursor.rowcount
+
+    def iter_rows(self, first_day, end_day, category=None, name=None):
+        """ Generate rows from first_day up to end_day whose category and name
+        match the glob patterns. """
+        with self.session() as connection:
+            for row in connection.execute(self.SELECT, {
+              "first": to_epoch(first_day), "end": to_epoch(end_day),
+              "category": category, "name": name}):
+                yield self.from_row(row)
+
+    def last(self):
+        """ the last activity, or None if there is none """
+        with self.session() as connection:
+            for row in connection.execute(self.LAST):
+                return self.from_row(row)
+        return None
+
+    def stop(self, now):
+        """ stop the activity in progress, if it was started today """
+        today = datetime.datetime(now.year, now.month, now.day)
+        with self.session() as connection:
+            with connection:
+                connection.execute(
+                  self.STOP, (to_epoch(now), to_epoch(today)))
+
+    def category_hours(self, first_day, end_day, now, category_hours=None):
+        """ Sum the hours by category for activities started on or after
+        first_day and before end_day. """
+        if category_hours is None:
+            category_hours = {}
+        now = to_epoch(now)
+        with self.session() as connection:
+            totals = connection.execute(self.CATEGORY_SECONDS, {
+              "today": now - now % 86400, "now": now,
+              "first": to_epoch(first_day), "end": to_epoch(end_day)})
+            for (category, seconds) in totals:
+                add_duration(category_hours, category, datetime.timedelta(
+                  seconds=seconds))
+        return category_hours
+
+    @staticmethod
+    def to_row(activity):
+        """ database row for an activity """
+        if activity.endtime == INPROGRESS:
+            endtime = None
+        else:
+            endtime = to_epoch(activity.endtime)
+        return (
+          to_epoch(activity.starttime), activity.name, activity.category,
+          endtime)
+
+    @staticmethod
+    def from_row(row):
+        """ activity for a database row """
+        (starttime, name, category, endtime) = row
+        if endtime is None:
+            endtime = INPROGRESS
+        else:
+            endtime = from_epoch(endtime)
+        return Activity(from_epoch(starttime), name, category, endtime)
+
+
+class MemoryBackend(Backend):
+    """ Every activity of another backend held in memory, with writes going
+    through to it. """
+    def __init__(self, backend):
+        self.backend = backend
+        self.timelog = backend.timelog
+        self.load()
+
+    def log_stamp(self):
+        """ (inode, size, mtime) of the timelog, or None if it does not
+        exist """
+        if hasattr(self.backend, "log_stamp"):
+            return self.backend.log_stamp()
+        try:
+            stat = os.stat(self.timelog)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime
+
+    def load(self):
+        """ load every activity from the backend """
+        self.activities = list(self.backend.iter_rows(FIRST_DAY, LAST_DAY))
+        self.starts = [activity.starttime for activity in self.activities]
+        (self.day_hours, self.running) = ({}, [])
+        self.add_totals(0)
+        self.stamp = self.log_stamp()
+
+    def refresh(self):
+        """ load again if the timelog was changed by someone else, only from
+        the last day if it grew """
+        stamp = self.log_stamp()
+        if stamp == self.stamp:
+            return
+        if isinstance(self.backend, TextBackend) and self.activities and (
+          None not in (stamp, self.stamp) and stamp[0] == self.stamp[0] and
+          stamp[1] >= self.stamp[1]):
+            self.reload_from(self.starts[-1])
+        else:
+            self.load()
+
+    def reload_from(self, starttime):
+        """ load again the activities from the day of starttime on, after
+        writing them through to the backend """
+        day = start_of_day(starttime)
+        from bisect import bisect_left
+        low = bisect_left(self.starts, day)
+        self.activities[low:] = self.backend.iter_rows(day, LAST_DAY)
+        self.starts[low:] = [a.starttime for a in self.activities[low:]]
+        for old_day in [key for key in self.day_hours if key >= day]:
+            del self.day_hours[old_day]
+        self.running = [a for a in self.running if a.starttime < day]
+        self.add_totals(low)
+        self.stamp = self.log_stamp()
+
+    def add_totals(self, low):
+        """ add the activities from index low on to the running totals by
+        day and category, keeping those in progress aside """
+        for activity in self.activities[low:]:
+            if activity.endtime == INPROGRESS:
+                self.running.append(activity)
+                continue
+            add_duration(
+              self.day_hours.setdefault(start_of_day(activity.starttime), {}),
+              activity.category, activity.endtime - activity.starttime)
+
+    def append(self, activity):
+        """ append one activity """
+        self.refresh()
+        self.backend.append(activity)
+        self.reload_from(activity.starttime)
+
+    def extend(self, activities):
+        """ append many activities; returns the number written """
+        count = self.backend.extend(activities)
+        self.load()
+        return count
+
+    def iter_rows(self, first_day, end_day, category=None, name=None):
+        """ Generate rows from first_day up to end_day whose category and name
+        match the glob patterns. """
+        self.refresh()
+        from bisect import bisect_left
+        for activity in self.activities[bisect_left(self.starts, first_day):]:
+            if activity.starttime >= end_day:
+                break
+            if matches(activity, category, name):
+                yield activity
+
+    def last(self):
+        """ the last activity, or None if there is none """
+        self.refresh()
+        return self.activities[-1] if self.activities else None
+
+    def stop(self, now):
+        """ stop the activity in progress, if it was started today """
+        self.refresh()
+        self.backend.stop(now)
+        self.reload_from(now)
+
+    def category_hours(self, first_day, end_day, now, category_hours=None):
+        """ Sum the hours by category for activities started on or after
+        first_day and before end_day. """
+        if category_hours is None:
+            category_hours = {}
+        return add_category_hours(
+          self.iter_rows(first_day, end_day), now, category_hours)
+
+    def sum_days(self, days, now, category_hours=None):
+        """ Sum the hours by category over days, from the running totals
+        and the activities in progress. """
+        if category_hours is None:
+            category_hours = {}
+        self.refresh()
+        days = set(start_of_day(day) for day in days)
+        for day in days:
+            for (category, duration) in self.day_hours.get(day, {}).items():
+                add_duration(category_hours, category, duration)
+        return add_category_hours((
+          activity for activity in self.running
+          if start_of_day(activity.starttime) in days), now, category_hours)
+
+
+class SegmentedBackend(Backend):
+    """ Activities stored in a directory with one text timelog per month, e.g.
+    2016-06.txt or 2016-06.txt.gz. """
+    def __init__(self, timelog=TIMELOG):
+        self.timelog = timelog
+
+    def segments(self):
+        """ sorted (month, path) of every segment, preferring a plain one to a
+        compressed one """
+        paths = {}
+        for filename in os.listdir(self.timelog):
+            month = filename[:len("YYYY-MM")]
+            if not (month[:4].isdigit() and month[4:5] == "-" and
+                    month[5:].isdigit()):
+                continue
+            if filename == month + SEGMENT_SUFFIX:
+                paths[month] = ospathjoin(self.timelog, filename)
+            elif filename == month + SEGMENT_SUFFIX + GZIP_SUFFIX:
+                paths.setdefault(month, ospathjoin(self.timelog, filename))
+        return sorted(paths.items())
+
+    def log_stamp(self):
+        """ names, sizes and mtimes of the segments """
+        return tuple(
+          (path, stat.st_size, stat.st_mtime) for (path, stat) in
+          ((path, os.stat(path)) for (month, path) in self.segments()))
+
+    def open_segment(self, month):
+        """ path of the plain segment for month, expanding it first if it
+        was compressed """
+        path = ospathjoin(self.timelog, month + SEGMENT_SUFFIX)
+        if not os.path.exists(path) and os.path.exists(path + GZIP_SUFFIX):
+            expand_segment(path)
+        return path
+
+    def append(self, activity):
+        """ append one activity to the segment of its month """
+        with TimelogLock(self.timelog):
+            path = self.open_segment(month_key(activity.starttime))
+            TextBackend(path).append(activity)
+
+    def extend(self, activities):
+        """ append many activities with one buffered write per month;
+        returns the number written """
+        from itertools import groupby
+        count = 0
+        with TimelogLock(self.timelog):
+            for (month, group) in groupby(
+              activities, lambda activity: month_key(activity.starttime)):
+                count += TextBackend(self.open_segment(month)).extend(group)
+        return count
+
+    def overlapping(self, first_day, end_day):
+        """ (month, path) of the segments that can hold activities starting
+        on or after first_day and before end_day """
+        (first_month, end_key) = (month_key(first_day), datetime_key(end_day))
+        for (month, path) in self.segments():
+            if month < first_month:
+                continue
+            if month + "-01T00:00:00" >= end_key:
+                break
+            yield month, path
+
+    def iter_rows(self, first_day, end_day, category=None, name=None):
+        """ Generate rows from first_day up to end_day whose category and name
+        match the glob patterns. """
+        for (month, path) in self.overlapping(first_day, end_day):
+            if path.endswith(GZIP_SUFFIX):
+                rows = iter_archive_rows(
+                  path, first_day, end_day, category, name)
+            else:
+                rows = TextBackend(path).iter_rows(
+                  first_day, end_day, category, name)
+            for activity in rows:
+                yield activity
+
+    def last(self):
+        """ the last activity, or None if there is none """
+        segments = self.segments()
+        if not segments:
+            return None
+        path = segments[-1][1]
+        if path.endswith(SEGMENT_SUFFIX):
+            return TextBackend(path).last()
+        last = None
+        for last in iter_archive_rows(path, FIRST_DAY, LAST_DAY):
+            pass
+        return last
+
+    def stop(self, now):
+        """ stop the activity in progress, if it was started today.  Only
+        the last segment can hold it. """
+        with TimelogLock(self.timelog):
+            segments = self.segments()
+            if segments and segments[-1][1].endswith(SEGMENT_SUFFIX):
+                TextBackend(segments[-1][1]).stop(now)
+
+    def category_hours(self, first_day, end_day, now, category_hours=None):
+        """ Sum the hours by category for activities started on or after
+        first_day and before end_day. """
+        table = get_table(first_day, end_day, self)
+        return table.category_hours(now, category_hours)
+
+    def sum_days(self, days, now, category_hours=None):
+        """ Sum the hours by category over days, using the rollup cache of
+        each plain segment. """
+        from itertools import groupby
+        if category_hours is None:
+            category_hours = {}
+        paths = dict(self.segments())
+        for (month, group) in groupby(days, month_key):
+            path = paths.get(month)
+            if path is None:
+                continue
+            if path.endswith(SEGMENT_SUFFIX):
+                TextBackend(path).sum_days(list(group), now, category_hours)
+                continue
+            for day in group:
+                add_category_hours(iter_archive_rows(
+                  path, day, day + datetime.timedelta(days=1)), now,
+                  category_hours)
+        return category_hours
+
+    def day_seconds(
+      self, first_day, end_day, now, jobs=1, category=None, name=None):
+        """ (categories, rows) as Backend.day_seconds, from the segments """
+        return table_day_seconds(
+          first_day, end_day, now, self, jobs, category, name)
+
+
 # COMMANDS
 def start(now, activity, category, timelog=TIMELOG):
-    """ Stop today's inprogress activity and start a new activity. """
-    stop(now, timelog)
-    activity = Activity(now, activity, category=category)
-    activity.writedb(timelog)
-    pass
+    """ Stop today's inprogress activity and start a new activity, under one
+    lock. """
+    with TimelogLock(timelog):
+        stop(now, timelog)
+        activity = Activity(now, activity, category=category)
+        with TracePhase("append"):
+            activity.writedb(timelog)
 
 
 def stop(now, timelog=TIMELOG):
     """ Determine if there is an activity in progress and stop it. """
-    # Generate a list of all activities that were started today
-    today = datetime.datetime(now.year, now.month, now.day)
-    activities = get_rows(today, timelog)
-    for activity in activities:
-        if activity.starttime < today:
-            continue
-        if activity.endtime != INPROGRESS:
-            continue
-        # Activity is in progress
-        activity_text = activity.__str__()
-        for line in fileinput.input(timelog, inplace=1):
-            if line.strip() != activity_text:
-                print(line.strip())
-                continue
-            # stop activity
-            log_activity = parse_line(line, timelog)
-            log_activity.endtime = now.strftime(DATETIMEFORMAT)
-            print(log_activity.__str__())
-            break  # assumes only 1 activity in progress
-        fileinput.close()
-        break
+    with TracePhase("stop"):
+        get_backend(timelog).stop(now)
     return
 
 
-def list_day(day, now, timelog=TIMELOG, print_totals=True):
-    """ print daily activity list """
-    activities = get_rows(day, timelog)
-    print(ACTIVITY_DAY_HEADER.format(
-      weekday=day.strftime("%A,"), day=day.strftime(DAYFORMAT)))
-    for activity in activities:
-        activity_text = activity.day_format(now)
-        print(activity_text)
-    print("")
+def migrate(source, destination):
+    """ Copy every activity from the source timelog to the destination,
+    e.g. to move a text timelog into SQLite or export one back. """
+    rows = get_backend(source).iter_rows(FIRST_DAY, LAST_DAY)
+    return get_backend(destination).extend(rows)
+
+
+def export(
+  first_day, end_day, form="csv", timelog=TIMELOG, fdout=None, jobs=1):
+    """ Write the activities from first_day up to end_day to fdout as csv or
+    jsonl; returns the number written. """
+    if fdout is None:
+        fdout = sys.stdout
+    if jobs > 1:
+        rows = iter(get_table(first_day, end_day, timelog, jobs))
+    else:
+        rows = iter_rows(first_day, end_day, timelog)
+    count = 0
+    if form == "csv":
+        import csv
+        writer = csv.writer(fdout, lineterminator="\n")
+        writer.writerow(EXPORT_FIELDS)
+        for activity in rows:
+            writer.writerow([
+              "" if field is None else field
+              for field in export_fields(activity)])
+            count += 1
+    else:
+        import json
+        for activity in rows:
+            fdout.write(json.dumps(
+              dict(zip(EXPORT_FIELDS, export_fields(activity)))) + "\n")
+            count += 1
+    return count
+
+
+def import_activities(activities, timelog=TIMELOG):
+    """ Append checked activities in one write; returns the number written. """
+    with TimelogLock(timelog):
+        backend = get_backend(timelog)
+        table = ActivityTable(check_activities(activities, backend.last()))
+        return backend.extend(iter(table))
+
+
+def batch(lines, timelog=TIMELOG):
+    """ Apply the start and stop commands on lines under one lock; returns the
+    number of commands and of activities appended. """
+    with TimelogLock(timelog):
+        backend = get_backend(timelog)
+        (stopped, activities, count) = apply_batch(
+          read_batch(lines), backend.last())
+        if stopped is not None:
+            backend.stop(stopped.endtime)
+        if activities:
+            backend.extend(activities)
+    return count, len(activities)
+
+
+def read_batch(lines):
+    """ Generate (line number, command, time, activity, category) for each
+    start or stop line. """
+    for (number, line) in enumerate(lines, 1):
+        words = line.split()
+        if not words or words[0].startswith("#"):
+            continue
+        stamp = words[1] if len(words) > 1 else ""
+        when = parse_timestamp([stamp]) if "T" in stamp else None
+        if when is None or words[0] not in ("start", "stop") or (
+          (words[0] == "stop") != (len(words) == 2)):
+            raise ValueError(
+              "line %d is not start TIMESTAMP activity@category or stop"
+              " TIMESTAMP" % number)
+        if words[0] == "stop":
+            yield number, "stop", when, None, None
+        else:
+            yield (number, "start", when) + split_activity_at_category(
+              words[2:])
+
+
+def apply_batch(commands, last=None):
+    """ Run commands after last in memory; returns (stopped copy of last or
+    None, new activities, number of commands). """
+    (stopped, activities, count) = (None, [], 0)
+    (current, latest) = (last, None)
+    if last is not None:
+        latest = last.starttime if last.endtime == INPROGRESS else max(
+          last.starttime, last.endtime)
+    for (number, command, when, name, category) in commands:
+        if latest is not None and when < latest:
+            raise ValueError(
+              "line %d is before the activity or command before it" % number)
+        (latest, count) = (when, count + 1)
+        if current is not None and current.endtime == INPROGRESS and (
+          current.starttime.date() == when.date()):
+            if current is last:
+                current = stopped = Activity(
+                  last.starttime, last.name, last.category)
+            current.endtime = when
+        if command == "start":
+            current = Activity(when, name, category)
+            activities.append(current)
+    return stopped, activities, count
+
+
+def check_activities(activities, previous=None):
+    """ Yield activities, raising ValueError at the first one out of order or
+    overlapping the one before it. """
+    for (number, activity) in enumerate(activities, 1):
+        if activity.endtime != INPROGRESS and (
+          activity.endtime < activity.starttime):
+            raise ValueError("activity %d ends before it starts" % number)
+        if previous is not None:
+            if activity.starttime < previous.starttime:
+                raise ValueError(
+                  "activity %d starts before the one before it" % number)
+            if overlaps_previous(activity, previous):
+                raise ValueError(
+                  "activity %d overlaps the one before it" % number)
+        previous = activity
+        yield activity
+
+
+def overlaps_previous(activity, previous):
+    """ True if activity starts before previous ends, or while previous is
+    in progress on the same day """
+    if previous.endtime == INPROGRESS:
+        return activity.starttime.date() == previous.starttime.date()
+    return activity.starttime < previous.endtime
+
+
+def compact(source, destination, now):
+    """ Split source into monthly segments in destination, compressing those
+    before now; returns the counts of both. """
+    count = 0
+    if os.path.isdir(source):
+        destination = source
+    else:
+        if not os.path.isdir(destination):
+            os.makedirs(destination)
+        count = migrate(source, destination)
+    return count, compress_segments(destination, now)
+
+
+def list_day(
+  day, now, timelog=TIMELOG, print_totals=True, category=None, name=None):
+    """ print daily activity list, optionally only of the activities whose
+    category and name match the glob patterns category and name """
+    with TracePhase("read"):
+        buckets = bucket_rows([day], timelog, category, name)
+    with TracePhase("print"):
+        print_day(day, buckets[day], now)
     if print_totals:
-        print_category_hours([day], now, timelog)
+        with TracePhase("durations"):
+            category_hours = sum_bucket_hours(buckets, now)
+        with TracePhase("print"):
+            print_category_totals(category_hours)
     return
 
 
-def list_week(now, timelog=TIMELOG):
+def list_week(now, timelog=TIMELOG, category=None, name=None):
     """ print weekly activity list """
+    list_days(week_days(now), now, timelog, category, name)
+    return
+
+
+def week_days(now):
+    """ the days of this week so far, from last Sunday """
     last_sunday = datetime.datetime(
       now.year, now.month, now.day) - datetime.timedelta(now.weekday() + 1)
     days = []
@@ -149,35 +1153,231 @@ def list_week(now, timelog=TIMELOG):
         this_day = last_sunday + datetime.timedelta(days=ii)
         if this_day > now:
             break
-        list_day(this_day, now, timelog, print_totals=False)
         days.append(this_day)
-    print_category_hours(days, now, timelog)
+    return days
+
+
+def list_days(days, now, timelog=TIMELOG, category=None, name=None):
+    """ print the activity list for each of days followed by the category
+    totals for all of them, reading the timelog only once. """
+    with TracePhase("read"):
+        buckets = bucket_rows(days, timelog, category, name)
+    print_days(days, buckets, now)
+    return
+
+
+def print_days(days, buckets, now):
+    """ print the activity list for each of days from buckets, as read by
+    bucket_rows, followed by the category totals for all of them """
+    with TracePhase("print"):
+        for day in days:
+            print_day(day, buckets[day], now)
+    with TracePhase("durations"):
+        category_hours = sum_bucket_hours(buckets, now)
+    with TracePhase("print"):
+        print_category_totals(category_hours)
+    return
+
+
+def at(moment, now, timelog=TIMELOG):
+    """ print the activities in progress at moment """
+    (first, end) = (moment, moment + datetime.timedelta(seconds=1))
+    print_intervals(
+      "ACTIVITIES AT %s" % (datetime_key(moment), ), first, end, now,
+      timelog)
+
+
+def overlaps(first, end, now, timelog=TIMELOG):
+    """ print the activities in progress at any time from first up to end
+    """
+    print_intervals(
+      "ACTIVITIES FROM %s TO %s" % (datetime_key(first), datetime_key(end)),
+      first, end, now, timelog)
+
+
+def print_intervals(title, first, end, now, timelog=TIMELOG):
+    """ Print the activities that overlap [first, end), marking with ! those
+    that overlap another. """
+    first_day = datetime.datetime(first.year, first.month, first.day)
+    table = get_table(first_day - datetime.timedelta(days=1), end, timelog)
+    index = IntervalIndex(table, now)
+    overlapping = index.overlapping()
+    print(INTERVALS_HEADER.format(title=title))
+    rows = index.overlaps(first, end)
+    for row in rows:
+        activity = table.row(row)
+        print("%s%s %s" % (
+          "!" if row in overlapping else " ",
+          activity.starttime.strftime(DAYFORMAT), activity.day_format(now)))
+    if not rows:
+        print("%44s" % "<no data>")
+    if overlapping.intersection(rows):
+        print("! overlaps another activity, so its time is counted twice")
+    print("")
+    return
+
+
+def list_range(
+  first_day, end_day, now, timelog=TIMELOG, jobs=1, category=None,
+  name=None):
+    """ print the hours spent each day in each category, from first_day up
+    to but not including end_day, followed by the category totals """
+    with TracePhase("read"):
+        (categories, rows) = get_backend(timelog).day_seconds(
+          first_day, end_day, now, jobs, category, name)
+    with TracePhase("durations"):
+        category_hours = {}
+        for (column, category) in enumerate(categories):
+            category_hours[category] = datetime.timedelta(
+              seconds=sum(row[column] for row in rows))
+    with TracePhase("print"):
+        print_range(first_day, categories, rows)
+        print_category_totals(category_hours)
+    return
+
+
+def table_day_seconds(
+  first_day, end_day, now, timelog=TIMELOG, jobs=1, category=None,
+  name=None):
+    """ (categories, rows) of the seconds by category on each day from
+    first_day up to end_day, from get_table """
+    table = get_table(first_day, end_day, timelog, jobs, category, name)
+    return table.day_category_seconds(
+      now, first_day, (end_day - first_day).days)
+
+
+def print_range(first_day, categories, rows):
+    """ Print one line per day with activity: its total hours and its
+    hours in each category. """
+    order = sorted(range(len(categories)), key=lambda ii: categories[ii])
+    widths = [max(len(categories[ii]), 6) for ii in order]
+    last_day = first_day + datetime.timedelta(days=len(rows) - 1)
+    print(RANGE_HEADER.format(
+      first=first_day.strftime(DAYFORMAT), last=last_day.strftime(DAYFORMAT)))
+    print(("%-14s %6s | " % ("   Day", "Total") + " | ".join(
+      "%*s" % (width, categories[ii]) for (ii, width) in zip(order, widths)
+      )).rstrip())
+    print("-" * 22 + "+" + "+".join("-" * (width + 2) for width in widths))
+    for (number, row) in enumerate(rows):
+        if not sum(row):
+            continue
+        day = first_day + datetime.timedelta(days=number)
+        print("%s %s %6s | " % (
+          day.strftime(DAYFORMAT), day.strftime("%a"), format_hours(sum(row)))
+          + " | ".join("%*s" % (width, format_hours(row[ii]))
+                       for (ii, width) in zip(order, widths)))
+    print("")
+    return
+
+
+def format_hours(seconds):
+    """ seconds as hours and minutes, e.g. 5:17 """
+    return "%d:%02d" % (seconds // 3600, (seconds // 60) % 60)
+
+
+def team(timelogs, first_day, end_day, now):
+    """ Print the category totals of each (name, timelog) in timelogs and of
+    the team, from first_day up to end_day. """
+    (user_hours, category_hours) = sum_team_hours(
+      iter_team_rows(timelogs, first_day, end_day), now)
+    print(TEAM_HEADER.format(
+      first=first_day.strftime(DAYFORMAT),
+      last=(end_day - datetime.timedelta(days=1)).strftime(DAYFORMAT)))
+    for (name, timelog) in timelogs:
+        print_category_totals(
+          user_hours.get(name, {}), "Category Totals for %s" % (name, ))
+        print("")
+    print_category_totals(category_hours, "Team Category Totals")
+    return
+
+
+def iter_team_rows(timelogs, first_day, end_day):
+    """ Merge the rows of many (name, timelog) into one stream of (name,
+    activity) in start time order. """
+    import heapq
+    streams = [
+      iter_team_stream(ii, name, timelog, first_day, end_day)
+      for (ii, (name, timelog)) in enumerate(timelogs)]
+    for (starttime, ii, name, activity) in heapq.merge(*streams):
+        yield name, activity
+
+
+def iter_team_stream(ii, name, timelog, first_day, end_day):
+    """ rows of one timelog decorated for iter_team_rows to merge """
+    for activity in iter_rows(first_day, end_day, timelog):
+        yield activity.starttime, ii, name, activity
+
+
+def sum_team_hours(rows, now):
+    """ Sum the hours by category of each user and of the team from (name,
+    activity) rows. """
+    (user_hours, category_hours) = ({}, {})
+    for (name, activity) in rows:
+        duration = activity.get_duration(now)
+        for totals in (user_hours.setdefault(name, {}), category_hours):
+            add_duration(totals, activity.category, duration)
+    return user_hours, category_hours
+
+
+def print_day(day, activities, now):
+    """ print the activity list for one day """
+    print(ACTIVITY_DAY_HEADER.format(
+      weekday=day.strftime("%A,"), day=day.strftime(DAYFORMAT)))
+    for activity in activities:
+        activity_text = activity.day_format(now)
+        print(activity_text)
+    print("")
     return
 
 
+def sum_hours(
+  first_day, end_day, now, timelog=TIMELOG, category=None, name=None):
+    """ Sum the hours by category from first_day up to end_day of the
+    activities matching the glob patterns category and name. """
+    return get_table(
+      first_day, end_day, timelog, 1, category, name).category_hours(now)
+
+
 def sum_category_hours(day, now, timelog=TIMELOG, category_hours=False):
     """ Sum the hours by category. """
     if not category_hours:
         category_hours = {}
-    activities = get_rows(day, timelog)
+    return get_backend(timelog).sum_days([day], now, category_hours)
+
+
+def add_category_hours(activities, now, category_hours):
+    """ Add the duration of each activity to its category total. """
     for activity in activities:
-        category = activity.category
-        duration = activity.get_duration(now)
-        if category in category_hours:
-            category_hours[category] += duration
-        else:
-            category_hours[category] = duration
+        add_duration(
+          category_hours, activity.category, activity.get_duration(now))
+    return category_hours
+
+
+def add_duration(category_hours, category, duration):
+    """ Add duration to the total of category. """
+    if category in category_hours:
+        category_hours[category] += duration
+    else:
+        category_hours[category] = duration
+
+
+def sum_bucket_hours(buckets, now):
+    """ Sum the hours by category over every day in buckets. """
+    category_hours = {}
+    for day in sorted(buckets.keys()):
+        add_category_hours(buckets[day], now, category_hours)
     return category_hours
 
 
 def print_category_hours(days, now, timelog=TIMELOG):
     """ Print Total hours spend in each category. """
-    # Compute totals
-    category_hours = {}
-    for day in days:
-        category_hours = sum_category_hours(day, now, timelog, category_hours)
+    print_category_totals(get_backend(timelog).sum_days(days, now))
+
+
+def print_category_totals(category_hours, title="Category Totals"):
+    """ Print precomputed category totals. """
     # Print header
-    print("%44s" % "Category Totals")
+    print("%44s" % title)
     # Print category totals
     sorted_categories = list(category_hours.keys())
     sorted_categories.sort()
@@ -192,9 +1392,232 @@ def print_category_hours(days, now, timelog=TIMELOG):
         print("%44s" % "<no data>")
 
 
+# LIBRARY
+class TimeLog(object):
+    """ A timelog for long-running programs, parsed once into a MemoryBackend
+    and safe to use from many threads. """
+    def __init__(self, timelog=TIMELOG):
+        import threading
+        self.timelog = expanduser(timelog)
+        self.lock = threading.RLock()
+        self.memory = None
+
+    def backend(self):
+        """ the MemoryBackend, loading it on first use """
+        with self.lock:
+            if self.memory is None:
+                self.memory = MemoryBackend(get_backend(self.timelog))
+            return self.memory
+
+    def start(self, activity, category=DEFAULT_CATEGORY, now=None):
+        """ stop the activity in progress and start activity in category,
+        now by default """
+        with self.lock, TimelogLock(self.timelog):
+            start(
+              now or datetime.datetime.now(), activity, category,
+              self.backend())
+
+    def stop(self, now=None):
+        """ stop the activity in progress, now by default """
+        with self.lock, TimelogLock(self.timelog):
+            stop(now or datetime.datetime.now(), self.backend())
+
+    def report_range(self, detail, now=None):
+        """ (first_day, end_day) of a report over "week", "month", "year"
+        or "FROM TO" days as YYYY-MM-DD, as list takes them, or None """
+        return report_range(detail.split(), now or datetime.datetime.now())
+
+    def rows(self, first_day=None, end_day=None, category=None, name=None):
+        """ the activities from first_day (today) up to end_day (the next day)
+        whose category and name match the glob patterns """
+        if first_day is None:
+            now = datetime.datetime.now()
+            first_day = datetime.datetime(now.year, now.month, now.day)
+        if end_day is None:
+            end_day = first_day + datetime.timedelta(days=1)
+        with self.lock:
+            return list(self.backend().iter_rows(
+              first_day, end_day, category, name))
+
+    def totals(
+      self, first_day=None, end_day=None, category=None, name=None,
+      now=None):
+        """ the hours by category of the activities rows returns, with an
+        activity in progress counted up to now """
+        return add_category_hours(
+          self.rows(first_day, end_day, category, name),
+          now or datetime.datetime.now(), {})
+
+
+class AsyncTimeLog(object):
+    """ A TimeLog for asyncio programs, whose methods run in an executor and
+    return futures. """
+    def __init__(self, timelog=TIMELOG, executor=None):
+        self.timelog = TimeLog(timelog)
+        self.executor = executor
+
+    def run(self, method, *args, **kwargs):
+        """ a future for the result of the TimeLog method, on the running
+        loop, or the current one when called before it runs """
+        import asyncio
+        from functools import partial
+        try:
+            loop = asyncio.get_running_loop()
+        except (AttributeError, RuntimeError):  # Python 3.6, or not running
+            loop = asyncio.get_event_loop()
+        return loop.run_in_executor(
+          self.executor, partial(method, *args, **kwargs))
+
+    def start(self, *args, **kwargs):
+        """ TimeLog.start, in the executor """
+        return self.run(self.timelog.start, *args, **kwargs)
+
+    def stop(self, *args, **kwargs):
+        """ TimeLog.stop, in the executor """
+        return self.run(self.timelog.stop, *args, **kwargs)
+
+    def rows(self, *args, **kwargs):
+        """ TimeLog.rows, in the executor """
+        return self.run(self.timelog.rows, *args, **kwargs)
+
+    def totals(self, *args, **kwargs):
+        """ TimeLog.totals, in the executor """
+        return self.run(self.timelog.totals, *args, **kwargs)
+
+
 # Utilities
+def record_bytes(activity):
+    """ the timelog line of activity, without a newline, as UTF-8 """
+    line = activity.__str__()
+    if isinstance(line, bytes):  # python 2 str, e.g. from sys.argv
+        return line
+    return line.encode("utf-8")
+
+
 def parse_line(line, timelog=TIMELOG):
     """ parse one line of the timelog. """
+    activity = parse_fixed_line(line)
+    if activity is None:
+        activity = parse_tolerant_line(line, timelog)
+    return activity
+
+
+def parse_fixed_line(line):
+    """ Parse a line in the exact layout written by Activity.__str__ by
+    slicing at known positions.  Returns None for any other line. """
+    if line[:10] != "STARTTIME=" or line[29:36] != "; NAME=":
+        return None
+    category_at = line.find("; CATEGORY=", 36)
+    endtime_at = line.find("; ENDTIME=", category_at)
+    if category_at < 0 or endtime_at < 0:
+        return None
+    starttime = parse_fixed_datetime(line[10:29])
+    endtime = line[endtime_at + 10:].strip()
+    if endtime != INPROGRESS:
+        endtime = parse_fixed_datetime(endtime)
+    if starttime is None or endtime is None:
+        return None
+    return Activity(
+      starttime, line[36:category_at], line[category_at + 11:endtime_at],
+      endtime)
+
+
+def parse_timestamp(words):
+    """ datetime of YYYY-MM-DDTHH:MM[:SS], YYYY-MM-DD HH:MM[:SS] or YYYY-MM-DD,
+    or None """
+    text = "T".join(words)
+    if len(text) == len("YYYY-MM-DD"):
+        text += "T00:00:00"
+    elif len(text) == len("YYYY-MM-DDTHH:MM"):
+        text += ":00"
+    return parse_fixed_datetime(text)
+
+
+def export_fields(activity):
+    """ the EXPORT_FIELDS of an activity; None for an activity in progress
+    has no endtime """
+    return (
+      datetime_key(activity.starttime), activity.name, activity.category,
+      None if activity.endtime == INPROGRESS else datetime_key(
+        activity.endtime))
+
+
+def import_activity(starttime, name, category, endtime=None):
+    """ Activity from the EXPORT_FIELDS of one imported record; raises
+    ValueError for a bad field. """
+    if endtime == INPROGRESS:
+        endtime = None
+    fields = (starttime, name, category or "", endtime or "")
+    if not all(isinstance(field, TEXT_TYPES) for field in fields):
+        raise ValueError("fields must be text: %r" % (fields, ))
+    if any("\n" in field or "; " in field for field in fields):
+        raise ValueError("fields may not hold a newline or '; ': %r" % (
+          fields, ))
+    start = parse_fixed_datetime(starttime)
+    end = parse_fixed_datetime(endtime) if endtime else INPROGRESS
+    if start is None or end is None:
+        raise ValueError("times must be YYYY-MM-DDTHH:MM:SS: %r" % (
+          fields, ))
+    return Activity(start, name, category or DEFAULT_CATEGORY, end)
+
+
+def import_record(number, fields):
+    """ import_activity of the fields of record number, naming the record
+    in any ValueError """
+    try:
+        return import_activity(*fields)
+    except ValueError as error:
+        raise ValueError("record %d: %s" % (number, error))
+
+
+def read_csv(fdin):
+    """ Generate the activities of csv records as written by export. """
+    import csv
+    for (number, row) in enumerate(csv.reader(fdin), 1):
+        if number == 1 and row[:1] == [EXPORT_FIELDS[0]]:
+            continue
+        if row and len(row) not in (3, 4):
+            raise ValueError("record %d has %d fields, not %d" % (
+              number, len(row), len(EXPORT_FIELDS)))
+        if row:
+            yield import_record(number, row)
+
+
+def read_jsonl(fdin):
+    """ Generate the activities of jsonl records as written by export. """
+    import json
+    for (number, line) in enumerate(fdin, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as error:
+            raise ValueError("record %d: %s" % (number, error))
+        if not isinstance(record, dict) or not (
+          "starttime" in record and "name" in record):
+            raise ValueError(
+              "record %d needs a starttime and a name" % (number, ))
+        yield import_record(number, (
+          record["starttime"], record["name"], record.get("category"),
+          record.get("endtime")))
+
+
+def parse_fixed_datetime(text):
+    """ Parse DATETIMEFORMAT text from its integer fields, or return None
+    if text is not laid out exactly as DATETIMEFORMAT writes it. """
+    if len(text) != 19 or text[4] + text[7] + text[10] + text[13] + text[
+      16] != "--T::":
+        return None
+    try:
+        return datetime.datetime(
+          int(text[0:4]), int(text[5:7]), int(text[8:10]),
+          int(text[11:13]), int(text[14:16]), int(text[17:19]))
+    except ValueError:
+        return None
+
+
+def parse_tolerant_line(line, timelog=TIMELOG):
+    """ parse one line of the timelog, allowing variations in layout. """
     if line.strip() == "" or line.strip()[0] == "#":
         return False
     (starttime, name, category, endtime) = line.split(";")
@@ -210,27 +1633,1465 @@ def parse_line(line, timelog=TIMELOG):
     return activity
 
 
-def get_rows(this_day, timelog=TIMELOG):
-    """ get rows from database """
-    activities = []
-    try:
-        with open(timelog, "r") as fdin:
-            for line in fdin:
-                activity = parse_line(line, timelog)
-                if not activity:
-                    continue
-                # Only lines for this_day
-                if activity.starttime < this_day:
-                    continue
-                if activity.starttime > this_day + datetime.timedelta(days=1):
-                    continue
-                activities.append(activity)
-    except:  # file does not exist, nothing to list
-        pass
+def start_of_day(when):
+    """ midnight at the start of the day of when """
+    return datetime.datetime(when.year, when.month, when.day)
+
+
+def datetime_key(when):
+    """ when in DATETIMEFORMAT, which sorts as text in time order; unlike
+    strftime this works for any year """
+    return "%04d-%02d-%02dT%02d:%02d:%02d" % (
+      when.year, when.month, when.day, when.hour, when.minute, when.second)
+
+
+def to_epoch(when):
+    """ seconds from EPOCH to the datetime when """
+    delta = when - EPOCH
+    return delta.days * 86400 + delta.seconds
+
+
+def from_epoch(seconds):
+    """ datetime that is seconds from EPOCH """
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+def find_last_record(fdin):
+    """ (offset, line) of the last record of an open binary timelog, or (None,
+    None) """
+    buf = map_timelog(fdin)
+    if buf is None:
+        return None, None
+    try:
+        end = len(buf)
+        while end > 0:
+            start = buf.rfind(b"\n", 0, end - 1) + 1
+            text = buf[start:end].strip()
+            if text != b"" and not text.startswith(b"#"):
+                return start, buf[start:end]
+            end = start
+    finally:
+        buf.close()
+    return None, None
+
+
+def map_timelog(fdin):
+    """ read only memory map of an open timelog, or None if it is empty """
+    import mmap
+    try:
+        return mmap.mmap(fdin.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:  # empty file
+        return None
+
+
+def next_record(buf, start, end):
+    """ (start, end) offsets of the first STARTTIME= line in buf[start:end], or
+    None """
+    while start < end:
+        stop = buf.find(b"\n", start, end)
+        stop = end if stop < 0 else stop + 1
+        if buf[start:start + 10] == b"STARTTIME=":
+            return start, stop
+        start = stop
+    return None
+
+
+def bisect_timelog(buf, key):
+    """ Binary search a timelog buffer for the offset of the first line whose
+    STARTTIME is key or later. """
+    (low, high) = (0, len(buf))
+    while low < high:
+        middle = (low + high) // 2
+        start = max(low, buf.rfind(b"\n", low, middle) + 1)
+        record = next_record(buf, start, high)
+        if record is None:  # only comments from start to high
+            high = start
+        elif buf[record[0] + 10:record[0] + 29] < key:
+            low = record[1]
+        else:
+            high = record[0]
+    return low
+
+
+def mmap_day_offset(day, timelog=TIMELOG):
+    """ offset of the first activity on or after day, by binary searching a
+    memory map of the timelog """
+    trace_count("files opened")
+    with open(timelog, "rb") as fdin:
+        buf = map_timelog(fdin)
+        if buf is None:
+            return 0
+        try:
+            return bisect_timelog(buf, datetime_key(day).encode("ascii"))
+        finally:
+            buf.close()
+
+
+def get_rows(this_day, timelog=TIMELOG):
+    """ get rows from database """
+    return get_rows_between(
+      this_day, this_day + datetime.timedelta(days=1), timelog)
+
+
+def get_rows_between(first_day, end_day, timelog=TIMELOG):
+    """ get rows that start on or after first_day and before end_day """
+    activities = []
+    try:
+        for activity in iter_rows(first_day, end_day, timelog):
+            activities.append(activity)
+    except ValueError:  # malformed line, list what was read
+        warn_malformed(timelog)
     return activities
 
 
+def get_table(
+  first_day, end_day, timelog=TIMELOG, jobs=1, category=None, name=None):
+    """ get an ActivityTable of the rows from first_day up to end_day matching
+    category and name, parsed by jobs processes """
+    if jobs > 1 and category is None and name is None:
+        return read_table(first_day, end_day, timelog, jobs)
+    table = ActivityTable()
+    try:
+        for activity in iter_rows(
+          first_day, end_day, timelog, category, name):
+            table.append(activity)
+    except ValueError:  # malformed line, tabulate what was read
+        warn_malformed(timelog)
+    return table
+
+
+def warn_malformed(timelog=TIMELOG):
+    """ tell the user on stderr that a malformed line cut a read short """
+    sys.stderr.write(
+      "WARNING: stopped at a malformed line in %s; run tracktime fsck\n" % (
+        getattr(timelog, "timelog", timelog), ))
+
+
+def iter_rows(first_day, end_day, timelog=TIMELOG, category=None, name=None):
+    """ Generate rows from first_day up to end_day whose category and name
+    match the glob patterns, such as "client*". """
+    return get_backend(timelog).iter_rows(first_day, end_day, category, name)
+
+
+def matches(activity, category=None, name=None):
+    """ True if the category and name of activity match the glob patterns
+    category and name; None matches anything """
+    from fnmatch import fnmatchcase
+    return (
+      (category is None or fnmatchcase(activity.category, category)) and
+      (name is None or fnmatchcase(activity.name, name)))
+
+
+def glob_literal(pattern):
+    """ the text before the first wildcard of a glob pattern, which any
+    line matching it contains; "" for None """
+    literal = pattern or ""
+    for character in GLOB_CHARACTERS:
+        literal = literal.split(character, 1)[0]
+    return literal
+
+
+def bucket_rows(days, timelog=TIMELOG, category=None, name=None):
+    """ Read the rows for all of days in a single pass; returns a dict mapping
+    each day to its activities. """
+    buckets = dict((day, []) for day in days)
+    if not days:
+        return buckets
+    first_day = min(days)
+    end_day = max(days) + datetime.timedelta(days=1)
+    try:
+        for activity in iter_rows(
+          first_day, end_day, timelog, category, name):
+            start = activity.starttime
+            day = datetime.datetime(start.year, start.month, start.day)
+            if day in buckets:
+                buckets[day].append(activity)
+    except ValueError:  # malformed line, list what was read
+        warn_malformed(timelog)
+    return buckets
+
+
+# Day Index
+def day_index_path(timelog=TIMELOG):
+    """ path of the sidecar day index kept next to the timelog """
+    return timelog + DAY_INDEX_SUFFIX
+
+
+def day_index_stamp(stat):
+    """ index header recording the timelog size and mtime it describes """
+    return (DAY_INDEX_HEADER % (stat.st_size, stat.st_mtime)).encode("ascii")
+
+
+def build_day_index(timelog=TIMELOG):
+    """ Scan the timelog and write the byte offset at which each day's
+    activities begin to the sidecar day index. """
+    stat = os.stat(timelog)
+    entries = []
+    last_day = ""
+    offset = 0
+    with open(timelog, "rb") as fdin:
+        for line in fdin:
+            day = line[10:20].decode("ascii", "replace")
+            if line.startswith(b"STARTTIME=") and day > last_day:
+                entries.append(DAY_INDEX_ENTRY % (day, offset))
+                last_day = day
+            offset += len(line)
+    write_atomic(
+      day_index_path(timelog),
+      day_index_stamp(stat) + "".join(entries).encode("ascii"))
+    return stat
+
+
+def read_day_index_entry(fdin, ii):
+    """ read entry ii of an open day index as (day, offset) """
+    fdin.seek(DAY_INDEX_HEADER_SIZE + ii * DAY_INDEX_ENTRY_SIZE)
+    (day, offset) = fdin.readline().decode("ascii").split(";")
+    (junk, day) = day.split("=")
+    (junk, offset) = offset.split("=")
+    return day, int(offset)
+
+
+def day_index_count(fdin):
+    """ number of entries in an open day index """
+    (count, partial) = divmod(
+      os.fstat(fdin.fileno()).st_size - DAY_INDEX_HEADER_SIZE,
+      DAY_INDEX_ENTRY_SIZE)
+    if partial:
+        raise ValueError("truncated day index")
+    return count
+
+
+def search_day_index(day, stat, timelog=TIMELOG):
+    """ Binary search the day index for the offset of the first activity on
+    or after day.  Returns None if the index does not match stat. """
+    key = datetime_key(day)[:len("YYYY-MM-DD")]
+    trace_count("files opened")
+    with open(day_index_path(timelog), "rb") as fdin:
+        if fdin.readline() != day_index_stamp(stat):
+            return None
+        count = day_index_count(fdin)
+        (low, high) = (0, count)
+        while low < high:
+            middle = (low + high) // 2
+            if read_day_index_entry(fdin, middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == count:
+            return stat.st_size
+        return read_day_index_entry(fdin, low)[1]
+
+
+def find_day_offset(day, timelog=TIMELOG):
+    """ byte offset of the first activity on or after day, from the day index
+    or the timelog """
+    stat = os.stat(timelog)
+    try:
+        offset = search_day_index(day, stat, timelog)
+    except (IOError, OSError, ValueError):  # missing or damaged index
+        offset = None
+    if offset is None:
+        offset = mmap_day_offset(day, timelog)
+    return offset
+
+
+def extend_day_index(starttime, old_stat, timelog=TIMELOG):
+    """ Record an activity just appended to the timelog in the day index. """
+    day = starttime.strftime(DAYFORMAT)
+    try:
+        if old_stat is None:  # the timelog was just created
+            with open(day_index_path(timelog), "wb") as fdout:
+                fdout.write(day_index_stamp(os.stat(timelog)))
+                fdout.write((DAY_INDEX_ENTRY % (day, 0)).encode("ascii"))
+            return
+        with open(day_index_path(timelog), "r+b") as fdidx:
+            if fdidx.readline() != day_index_stamp(old_stat):
+                raise ValueError("stale day index")
+            count = day_index_count(fdidx)
+            if count == 0 or read_day_index_entry(fdidx, count - 1)[0] < day:
+                fdidx.seek(0, os.SEEK_END)
+                fdidx.write((DAY_INDEX_ENTRY % (
+                  day, old_stat.st_size)).encode("ascii"))
+            fdidx.seek(0)
+            fdidx.write(day_index_stamp(os.stat(timelog)))
+    except (IOError, OSError, ValueError):  # missing, damaged or stale
+        rebuild_day_index(timelog)
+    return
+
+
+def rebuild_day_index(timelog=TIMELOG):
+    """ rebuild the day index, if the timelog can be read """
+    try:
+        build_day_index(timelog)
+    except (IOError, OSError):
+        pass
+    return
+
+
+# Rollup Cache
+def rollup_path(timelog=TIMELOG):
+    """ path of the sidecar rollup cache kept next to the timelog """
+    return timelog + ROLLUP_SUFFIX
+
+
+def rollup_header(stat, open_day, open_offset):
+    """ rollup header recording the timelog size and mtime it describes,
+    and the day (and its offset) that is still open and not cached """
+    return (ROLLUP_HEADER % (
+      stat.st_size, stat.st_mtime, open_day, open_offset)).encode("ascii")
+
+
+def read_rollup_header(header):
+    """ (open_day, open_offset) recorded in a rollup header """
+    (size, mtime, open_day, open_offset) = header.decode("ascii").split("; ")
+    (junk, open_day) = open_day.split("=")
+    (junk, open_offset) = open_offset.split("=")
+    return open_day, int(open_offset)
+
+
+def rollup_entries(day_seconds):
+    """ rollup lines for a {day: {category: seconds}} dict """
+    entries = []
+    for day in sorted(day_seconds.keys()):
+        for category in sorted(day_seconds[day].keys()):
+            entries.append(ROLLUP_ENTRY % (
+              day, day_seconds[day][category], category))
+    return "".join(entries).encode("utf-8")
+
+
+def scan_day_seconds(fdin, offset, size):
+    """ Sum the seconds by day and category of an open timelog from offset up
+    to size. """
+    day_seconds = {}
+    (last_day, last_offset) = (NO_DAY, offset)
+    fdin.seek(offset)
+    for line in fdin:
+        if offset >= size:
+            break
+        activity = parse_line(line.decode("utf-8"))
+        if activity:
+            day = datetime_key(activity.starttime)[:len(NO_DAY)]
+            if day > last_day:
+                (last_day, last_offset) = (day, offset)
+            duration = activity.get_duration(LAST_DAY)
+            totals = day_seconds.setdefault(day, {})
+            totals[activity.category] = totals.get(activity.category, 0) + (
+              duration.days * 86400 + duration.seconds)
+        offset += len(line)
+    return day_seconds, last_day, last_offset
+
+
+def build_rollup(timelog=TIMELOG):
+    """ Scan the timelog and write the seconds per category for every day
+    but the last (open) one to the sidecar rollup cache. """
+    stat = os.stat(timelog)
+    with open(timelog, "rb") as fdin:
+        (day_seconds, open_day, open_offset) = scan_day_seconds(
+          fdin, 0, stat.st_size)
+    day_seconds.pop(open_day, None)
+    write_atomic(
+      rollup_path(timelog),
+      rollup_header(stat, open_day, open_offset) + rollup_entries(day_seconds))
+    return stat
+
+
+def load_rollup(stat, first_day=FIRST_DAY, end_day=LAST_DAY, timelog=TIMELOG):
+    """ (entries, open_day) of the rollup cache from first_day up to end_day,
+    or None if it does not match stat """
+    trace_count("files opened")
+    with open(rollup_path(timelog), "rb") as fdin:
+        header = fdin.readline()
+        (open_day, open_offset) = read_rollup_header(header)
+        if header != rollup_header(stat, open_day, open_offset):
+            return None
+        buf = map_timelog(fdin)
+    end_key = datetime_key(end_day)[:len(NO_DAY)].encode("ascii")
+    entries = []
+    try:
+        start = bisect_rollup(
+          buf, len(header), datetime_key(first_day)[:len(NO_DAY)])
+        while start < len(buf) and buf[start + 4:start + 14] < end_key:
+            stop = buf.find(b"\n", start) + 1 or len(buf)
+            entries.append(read_rollup_entry(buf[start:stop]))
+            start = stop
+    finally:
+        buf.close()
+    return entries, open_day
+
+
+def bisect_rollup(buf, low, key):
+    """ offset of the first entry in a rollup cache buffer, from offset low
+    on, whose DAY is key (as YYYY-MM-DD) or later """
+    (high, key) = (len(buf), key.encode("ascii"))
+    while low < high:
+        middle = (low + high) // 2
+        start = max(low, buf.rfind(b"\n", low, middle) + 1)
+        if buf[start + 4:start + 14] < key:
+            low = buf.find(b"\n", start) + 1 or high
+        else:
+            high = start
+    return low
+
+
+def read_rollup_entry(line):
+    """ (day, category, seconds) of one rollup cache line """
+    (day, seconds, category) = line.decode("utf-8").split("; ", 2)
+    return day[4:], category.rstrip("\n")[len("CATEGORY="):], int(seconds[8:])
+
+
+def get_rollup(first_day=FIRST_DAY, end_day=LAST_DAY, timelog=TIMELOG):
+    """ load_rollup, rebuilding the rollup cache first if it is missing or
+    stale """
+    stat = os.stat(timelog)
+    try:
+        rollup = load_rollup(stat, first_day, end_day, timelog)
+    except (IOError, OSError, ValueError):  # missing or damaged cache
+        rollup = None
+    if rollup is None:
+        rollup = load_rollup(
+          build_rollup(timelog), first_day, end_day, timelog)
+    if rollup is None:  # changed while it was rebuilt, read it all live
+        return [], FIRST_DAY
+    (entries, open_day) = rollup
+    if open_day == NO_DAY:
+        return entries, FIRST_DAY
+    return entries, datetime.datetime(
+      int(open_day[0:4]), int(open_day[5:7]), int(open_day[8:10]))
+
+
+def add_rollup_seconds(categories, rows, entries, first_day, category=None):
+    """ Add the rollup cache entries matching category to the (categories,
+    rows) of day_category_seconds. """
+    from fnmatch import fnmatchcase
+    columns = dict((name, column) for (column, name) in enumerate(categories))
+    numbers = {}
+    for (day, name, seconds) in entries:
+        if category is not None and not fnmatchcase(name, category):
+            continue
+        if day not in numbers:
+            numbers[day] = (datetime.datetime(
+              int(day[0:4]), int(day[5:7]), int(day[8:10])) - first_day).days
+        column = columns.get(name)
+        if column is None:
+            column = columns[name] = len(categories)
+            categories.append(name)
+            for row in rows:
+                row.append(0)
+        rows[numbers[day]][column] += seconds
+
+
+def extend_rollup(starttime, old_stat, timelog=TIMELOG):
+    """ Record an activity just appended to the timelog in the rollup. """
+    day = datetime_key(starttime)[:len(NO_DAY)]
+    try:
+        if old_stat is None:  # the timelog was just created
+            with open(rollup_path(timelog), "wb") as fdout:
+                fdout.write(rollup_header(os.stat(timelog), day, 0))
+            return
+        with open(rollup_path(timelog), "r+b") as fdcache:
+            header = fdcache.readline()
+            (open_day, open_offset) = read_rollup_header(header)
+            if header != rollup_header(old_stat, open_day, open_offset):
+                return
+            if day < open_day:  # out of order, rebuilt on the next read
+                return
+            if day > open_day:
+                with open(timelog, "rb") as fdin:
+                    day_seconds = scan_day_seconds(
+                      fdin, open_offset, old_stat.st_size)[0]
+                fdcache.seek(0, os.SEEK_END)
+                fdcache.write(rollup_entries(day_seconds))
+                (open_day, open_offset) = (day, old_stat.st_size)
+            fdcache.seek(0)
+            fdcache.write(
+              rollup_header(os.stat(timelog), open_day, open_offset))
+    except (IOError, OSError, ValueError):  # rebuilt on the next read
+        pass
+    return
+
+
+# Term Index
+def terms_path(timelog=TIMELOG):
+    """ path of the sidecar term index kept next to the timelog """
+    return timelog + TERMS_SUFFIX
+
+
+def terms_header(stat, postings, tail):
+    """ term index header recording the timelog size and mtime it
+    describes, where its postings start and where its tail starts """
+    return (TERMS_HEADER % (
+      stat.st_size, stat.st_mtime, postings, tail)).encode("ascii")
+
+
+def read_terms_header(fdidx, stat):
+    """ (postings, tail) from the header of an open term index, or None if
+    it does not describe the timelog at stat """
+    header = fdidx.read(TERMS_HEADER_SIZE)
+    fields = header.decode("ascii").split("; ")
+    if len(fields) != 4:
+        raise ValueError("damaged term index")
+    (postings, tail) = (int(fields[2][9:]), int(fields[3][5:]))
+    if header != terms_header(stat, postings, tail):
+        return None
+    return postings, tail
+
+
+def activity_terms(activity, offset):
+    """ the term index entries of an activity on the line at offset """
+    return {
+      ("CATEGORY", activity.category): [offset],
+      ("NAME", activity.name): [offset]}
+
+
+def write_terms(terms, stat, timelog=TIMELOG):
+    """ Write a {(field, term): [offset, ...]} dict as the term index of the
+    timelog at stat. """
+    (directory, postings, at) = ([], [], 0)
+    for ((field, term), offsets) in sorted(terms.items()):
+        directory.append(TERMS_ENTRY % (field, term, at, len(offsets)))
+        postings.extend(TERMS_POSTING % offset for offset in sorted(offsets))
+        at += len(offsets) * TERMS_POSTING_SIZE
+    directory = "".join(directory).encode("utf-8")
+    start = TERMS_HEADER_SIZE + len(directory)
+    write_atomic(terms_path(timelog), terms_header(
+      stat, start, start + at) + directory + "".join(postings).encode("ascii"))
+
+
+def build_terms(timelog=TIMELOG):
+    """ Scan the timelog and write the byte offsets of the lines of each
+    category and each name to the sidecar term index. """
+    stat = os.stat(timelog)
+    terms = {}
+    offset = 0
+    with open(timelog, "rb") as fdin:
+        for line in fdin:
+            activity = parse_line(line.decode("utf-8"), timelog)
+            if activity:
+                for (key, offsets) in activity_terms(activity, offset).items():
+                    terms.setdefault(key, []).extend(offsets)
+            offset += len(line)
+    write_terms(terms, stat, timelog)
+    return
+
+
+def read_directory(fdidx, postings):
+    """ (field, term, at, count) of each directory entry of an open term
+    index whose postings start at postings """
+    fdidx.seek(TERMS_HEADER_SIZE)
+    entries = []
+    for line in fdidx.read(postings - TERMS_HEADER_SIZE).decode(
+      "utf-8").splitlines():
+        (key, location) = line.rsplit("; AT=", 1)
+        (field, term) = key.split("=", 1)
+        (at, count) = location.split("; COUNT=")
+        entries.append((field, term, int(at), int(count)))
+    return entries
+
+
+def read_tail(fdidx, tail):
+    """ (field, term, offset) of each entry appended to an open term index
+    since it was last written whole """
+    fdidx.seek(tail)
+    entries = []
+    for line in fdidx.read().decode("utf-8").splitlines():
+        (key, offset) = line.rsplit("; OFFSET=", 1)
+        (field, term) = key.split("=", 1)
+        entries.append((field, term, int(offset)))
+    return entries
+
+
+def posting_index(fdidx, start, count, offset):
+    """ index of the first of count postings at start in an open term index
+    that is offset or more """
+    (low, high) = (0, count)
+    while low < high:
+        middle = (low + high) // 2
+        fdidx.seek(start + middle * TERMS_POSTING_SIZE)
+        if int(fdidx.read(TERMS_POSTING_SIZE)) < offset:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def read_postings(fdidx, start, count, first_offset=0, end_offset=None):
+    """ the offsets from first_offset up to end_offset (or the end) among
+    the count postings at start in an open term index """
+    low = posting_index(fdidx, start, count, first_offset)
+    high = count if end_offset is None else posting_index(
+      fdidx, start, count, end_offset)
+    fdidx.seek(start + low * TERMS_POSTING_SIZE)
+    return [int(number) for number in fdidx.read(
+      max(high - low, 0) * TERMS_POSTING_SIZE).split()]
+
+
+def load_terms(fdidx, postings, tail):
+    """ every entry of an open term index as a {(field, term): [offset,
+    ...]} dict """
+    terms = {}
+    for (field, term, at, count) in read_directory(fdidx, postings):
+        terms[field, term] = read_postings(fdidx, postings + at, count)
+    for (field, term, offset) in read_tail(fdidx, tail):
+        terms.setdefault((field, term), []).append(offset)
+    return terms
+
+
+def search_terms(
+  field, pattern, stat, timelog=TIMELOG, first_offset=0, end_offset=None):
+    """ Sorted offsets from first_offset up to end_offset of the lines whose
+    field matches pattern, or None if the index is stale. """
+    from fnmatch import fnmatchcase
+    offsets = []
+    trace_count("files opened")
+    with open(terms_path(timelog), "rb") as fdidx:
+        header = read_terms_header(fdidx, stat)
+        if header is None:
+            return None
+        (postings, tail) = header
+        for (name, term, at, count) in read_directory(fdidx, postings):
+            if name == field and fnmatchcase(term, pattern):
+                offsets.extend(read_postings(
+                  fdidx, postings + at, count, first_offset, end_offset))
+        for (name, term, offset) in read_tail(fdidx, tail):
+            if name == field and first_offset <= offset and (
+              end_offset is None or offset < end_offset) and (
+              fnmatchcase(term, pattern)):
+                offsets.append(offset)
+    offsets.sort()
+    return offsets
+
+
+def term_offsets(
+  category=None, name=None, timelog=TIMELOG, first_offset=0,
+  end_offset=None):
+    """ Sorted offsets in range of the lines matching category and name, or
+    None to read the whole timelog. """
+    if category is None and name is None:
+        return None
+    selected = None
+    for (field, pattern) in zip(TERMS_FIELDS, (category, name)):
+        if pattern is None:
+            continue
+        offsets = get_terms(field, pattern, timelog, first_offset, end_offset)
+        if offsets is None:
+            return None
+        if selected is not None:
+            offsets = sorted(selected.intersection(offsets))
+        selected = set(offsets)
+    return offsets
+
+
+def get_terms(
+  field, pattern, timelog=TIMELOG, first_offset=0, end_offset=None):
+    """ search_terms, rebuilding the term index first if it is missing or
+    stale.  Returns None if it cannot be built. """
+    try:
+        offsets = search_terms(
+          field, pattern, os.stat(timelog), timelog, first_offset, end_offset)
+    except (IOError, OSError, ValueError):  # missing or damaged index
+        offsets = None
+    if offsets is not None:
+        return offsets
+    try:
+        build_terms(timelog)
+        return search_terms(
+          field, pattern, os.stat(timelog), timelog, first_offset, end_offset)
+    except (IOError, OSError, ValueError):  # unreadable timelog
+        return None
+
+
+def extend_terms(activity, old_stat, timelog=TIMELOG):
+    """ Record an activity just appended to the timelog, or None after a stop,
+    in the tail of the term index. """
+    try:
+        if old_stat is None:  # the timelog was just created
+            write_terms(activity_terms(activity, 0), os.stat(timelog), timelog)
+            return
+        with open(terms_path(timelog), "r+b") as fdidx:
+            header = read_terms_header(fdidx, old_stat)
+            if header is None:
+                return
+            (postings, tail) = header
+            terms = {} if activity is None else activity_terms(
+              activity, old_stat.st_size)
+            fdidx.seek(0, os.SEEK_END)
+            if fdidx.tell() >= tail + TERMS_TAIL_LIMIT:
+                merged = load_terms(fdidx, postings, tail)
+                for (key, offsets) in merged.items():
+                    terms.setdefault(key, []).extend(offsets)
+                write_terms(terms, os.stat(timelog), timelog)
+                return
+            fdidx.write("".join(
+              TERMS_TAIL_ENTRY % (field, term, offset)
+              for ((field, term), offsets) in sorted(terms.items())
+              for offset in offsets).encode("utf-8"))
+            fdidx.seek(0)
+            fdidx.write(terms_header(os.stat(timelog), postings, tail))
+    except (IOError, OSError, ValueError):  # rebuilt on the next read
+        pass
+    return
+
+
+# Checking
+def line_keys(line):
+    """ (start, end) of a timelog line as bytes, end None in progress; False
+    for a blank line or comment, None if malformed """
+    try:
+        text = line.decode("utf-8")
+    except ValueError:  # not UTF-8
+        return None
+    keys = fixed_keys(line)
+    if keys is not None:
+        return keys
+    if text.strip() == "" or text.strip()[0] == "#":
+        return False
+    try:
+        activity = parse_tolerant_line(text)
+    except ValueError:  # malformed
+        return None
+    if activity.endtime == INPROGRESS:
+        return datetime_key(activity.starttime).encode("ascii"), None
+    return (datetime_key(activity.starttime).encode("ascii"),
+            datetime_key(activity.endtime).encode("ascii"))
+
+
+def fixed_keys(line):
+    """ line_keys of a line as written by Activity.__str__, or None """
+    if line[:10] != b"STARTTIME=" or line[29:36] != b"; NAME=":
+        return None
+    category_at = line.find(b"; CATEGORY=", 36)
+    endtime_at = line.find(b"; ENDTIME=", max(category_at, 36))
+    (start, end) = (line[10:29], line[endtime_at + 10:].rstrip())
+    if category_at < 0 or endtime_at < 0 or not valid_key(start):
+        return None
+    if end == INPROGRESS_KEY:
+        return start, None
+    return (start, end) if valid_key(end) else None
+
+
+def valid_key(key):
+    """ True if key is a valid time as DATETIMEFORMAT bytes """
+    (day, time) = (key[:10], key[11:])
+    return len(key) == 19 and key[10:11] == b"T" and (
+      VALID_PARTS.get(day) or valid_part(day)) and (
+      VALID_PARTS.get(time) or valid_part(time))
+
+
+def valid_part(part):
+    """ True if part is a valid YYYY-MM-DD day or HH:MM:SS time of day, as
+    bytes """
+    if part not in VALID_PARTS:
+        text = part.decode("ascii", "replace")
+        if len(text) == len("YYYY-MM-DD"):
+            key = text + "T00:00:00"
+        else:
+            key = "2000-01-01T" + text
+        VALID_PARTS[part] = text.replace("-", "").replace(
+          ":", "").isdigit() and parse_fixed_datetime(key) is not None
+    return VALID_PARTS[part]
+
+
+class TimelogChecker(object):
+    """ Check the records of a timelog one at a time, in constant memory. """
+    def __init__(self):
+        self.latest_start = (b"", 0)
+        self.latest_end = (b"", 0)
+        self.open = None
+        self.lines = 0
+
+    def check_line(self, number, line):
+        """ (number, problem) for each problem of line number of the
+        timelog, given as bytes """
+        self.lines += 1
+        keys = line_keys(line)
+        if keys is None:
+            return [(number, "malformed line")]
+        if not keys:
+            return []
+        return self.check(number, keys[0], keys[1])
+
+    def check(self, number, start, end):
+        """ (number, problem) for each problem of the record on line number
+        running from start to end, as given by line_keys """
+        problems = []
+        if self.open is not None and self.open[0][:10] == start[:10]:
+            problems.append((self.open[1], (
+              "in progress, but line %d starts after it" % number)))
+        if end is not None and end < start:
+            problems.append((number, "ends before it starts"))
+        if start < self.latest_start[0]:  # out of order, not an overlap
+            problems.append((
+              number, "starts before line %d" % self.latest_start[1]))
+        elif start < self.latest_end[0]:
+            problems.append((number, "overlaps line %d" % self.latest_end[1]))
+        if start > self.latest_start[0]:
+            self.latest_start = (start, number)
+        if end is not None and end > self.latest_end[0]:
+            self.latest_end = (end, number)
+        self.open = (start, number) if end is None else None
+        return problems
+
+
+def check_timelog(timelog=TIMELOG, checker=None):
+    """ Generate (line number, problem) for each problem of a text timelog. """
+    if checker is None:
+        checker = TimelogChecker()
+    trace_count("files opened")
+    with open(timelog, "rb") as fdin:
+        for (number, line) in enumerate(fdin, 1):
+            for problem in checker.check_line(number, line):
+                yield problem
+
+
+def repair_timelog(timelog=TIMELOG):
+    """ Rewrite a text timelog with its problems fixed and the changed lines
+    kept as comments; returns the number changed. """
+    with TimelogLock(timelog):
+        with open(timelog, "rb") as fdin:
+            (records, trailer, changed) = read_records(fdin)
+        order = list(records)
+        records.sort(key=lambda record: record[0])
+        changed += sum(
+          1 for (old, new) in zip(order, records) if old is not new)
+        for (record, following) in zip(records, records[1:] + [None]):
+            changed += repair_record(record, following)
+        lines = []
+        for record in records:
+            lines.extend(record[3])
+            lines.append(record[2])
+        write_atomic(timelog, b"".join(lines + trailer))
+    return changed
+
+
+def read_records(fdin):
+    """ Read an open binary timelog as records [start, end, line, leading
+    lines], trailing lines and a malformed count. """
+    (records, leading, changed) = ([], [], 0)
+    for line in fdin:
+        if not line.endswith(b"\n"):
+            line += b"\n"
+        keys = line_keys(line)
+        if keys:
+            records.append([keys[0], keys[1], line, leading])
+            leading = []
+        elif keys is None:
+            leading.append(b"# fsck: malformed: " + line)
+            changed += 1
+        else:
+            leading.append(line)
+    return records, leading, changed
+
+
+def repair_record(record, following):
+    """ End record at the start of the following one (or its own) if it needs
+    to; returns 1 if changed, else 0. """
+    (start, end, line) = record[:3]
+    new_end = end
+    if end is not None and end < start:
+        new_end = start
+    if following is not None and (
+      end is None and following[0][:10] == start[:10] or
+      end is not None and new_end > following[0]):
+        new_end = following[0]
+    if new_end == end:
+        return 0
+    activity = parse_line(line.decode("utf-8"))
+    activity.endtime = parse_fixed_datetime(new_end.decode("ascii"))
+    record[3].append(b"# fsck: " + line)
+    record[1:3] = [new_end, record_bytes(activity) + b"\n"]
+    return 1
+
+
+# Parallel Parsing
+def read_table(first_day, end_day, timelog=TIMELOG, jobs=2):
+    """ get_table, parsing chunks of the timelog in jobs processes """
+    tasks = parse_tasks(first_day, end_day, timelog, jobs)
+    if tasks is None:
+        return get_table(first_day, end_day, timelog)
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+    except ImportError:  # Python 2 without the futures backport
+        results = [parse_chunk(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(jobs) as executor:
+            results = list(executor.map(parse_chunk, tasks))
+    table = ActivityTable()
+    for (chunk, complete) in results:
+        table.extend(chunk)
+        if not complete:  # malformed line, tabulate what was read
+            warn_malformed(timelog)
+            break
+    return table
+
+
+def parse_tasks(first_day, end_day, timelog, jobs):
+    """ chunks (path, start, end, first_day, end_day) for read_table, or None
+    for a backend not stored as text """
+    backend = get_backend(timelog)
+    if isinstance(backend, SegmentedBackend):
+        paths = [path for (month, path) in backend.overlapping(
+          first_day, end_day)]
+    elif isinstance(backend, TextBackend):
+        paths = [backend.timelog] if os.path.exists(backend.timelog) else []
+    else:
+        return None
+    tasks = []
+    for path in paths:
+        if path.endswith(GZIP_SUFFIX):
+            tasks.append((path, 0, 0, first_day, end_day))
+            continue
+        start = find_day_offset(first_day, path)
+        end = os.path.getsize(path)
+        if end_day < LAST_DAY and datetime_key(end_day).endswith("00:00:00"):
+            end = find_day_offset(end_day, path)
+        tasks.extend(
+          (path, low, high, first_day, end_day)
+          for (low, high) in chunk_offsets(path, start, end, jobs * 4))
+    return tasks
+
+
+def chunk_offsets(path, start, end, count):
+    """ Split bytes start to end of path into up to count (low, high)
+    ranges, each beginning at the start of a line. """
+    offsets = [start]
+    with open(path, "rb") as fdin:
+        for ii in range(1, count):
+            position = start + (end - start) * ii // count
+            if position <= offsets[-1]:
+                continue
+            fdin.seek(position - 1)
+            fdin.readline()
+            offset = min(fdin.tell(), end)
+            if offset > offsets[-1]:
+                offsets.append(offset)
+    if end > offsets[-1]:
+        offsets.append(end)
+    return list(zip(offsets, offsets[1:]))
+
+
+def parse_chunk(task):
+    """ Parse one task of parse_tasks into an ActivityTable, in a worker
+    process.  Returns the table and False if a malformed line ended it. """
+    (path, start, end, first_day, end_day) = task
+    table = ActivityTable()
+    if path.endswith(GZIP_SUFFIX):
+        rows = iter_archive_rows(path, first_day, end_day)
+    else:
+        rows = iter_chunk_rows(path, start, end, first_day, end_day)
+    try:
+        for activity in rows:
+            table.append(activity)
+    except ValueError:  # malformed line, keep what was read
+        return table, False
+    return table, True
+
+
+def iter_chunk_rows(path, start, end, first_day, end_day):
+    """ Generate the rows in bytes start to end of a text timelog that
+    start on or after first_day and before end_day. """
+    with open(path, "rb") as fdin:
+        fdin.seek(start)
+        text = fdin.read(end - start).decode("utf-8")
+    for line in text.split("\n"):
+        activity = parse_line(line, path)
+        if activity and first_day <= activity.starttime < end_day:
+            yield activity
+
+
+# Segments
+def month_key(when):
+    """ YYYY-MM of a datetime, naming its segment """
+    return "%04d-%02d" % (when.year, when.month)
+
+
+def iter_archive_rows(path, first_day, end_day, category=None, name=None):
+    """ Generate rows of a compressed segment from first_day up to end_day
+    matching category and name. """
+    import gzip
+    trace_count("files opened")
+    with gzip.open(path, "rb") as fdin:
+        for line in fdin:
+            activity = parse_line(line.decode("utf-8"), path)
+            if not activity or activity.starttime < first_day:
+                continue
+            if activity.starttime >= end_day:
+                break
+            if matches(activity, category, name):
+                yield activity
+
+
+def remove_sidecars(path):
+    """ remove a segment's day index, rollup cache, term index and lock
+    file """
+    for sidecar in (
+      day_index_path(path), rollup_path(path), terms_path(path),
+      lock_path(path)):
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+
+
+def compress_segment(path):
+    """ Replace the plain segment at path with path.gz.  The compressed
+    file is complete before the plain one is removed. """
+    import gzip
+    import shutil
+    temporary = "%s.%d.tmp" % (path + GZIP_SUFFIX, os.getpid())
+    with open(path, "rb") as fdin:
+        with gzip.open(temporary, "wb") as fdout:
+            shutil.copyfileobj(fdin, fdout)
+    getattr(os, "replace", os.rename)(temporary, path + GZIP_SUFFIX)
+    os.remove(path)
+    remove_sidecars(path)
+
+
+def expand_segment(path):
+    """ Replace the compressed segment path.gz with the plain one at path,
+    so that it can be appended to again. """
+    import gzip
+    import shutil
+    temporary = "%s.%d.tmp" % (path, os.getpid())
+    with gzip.open(path + GZIP_SUFFIX, "rb") as fdin:
+        with open(temporary, "wb") as fdout:
+            shutil.copyfileobj(fdin, fdout)
+    getattr(os, "replace", os.rename)(temporary, path)
+    os.remove(path + GZIP_SUFFIX)
+
+
+def compress_segments(timelog, now):
+    """ Compress the plain segments of months before the month of now;
+    returns how many were compressed. """
+    backend = SegmentedBackend(timelog)
+    count = 0
+    with TimelogLock(timelog):
+        for (month, path) in backend.segments():
+            if month < month_key(now) and path.endswith(SEGMENT_SUFFIX):
+                compress_segment(path)
+                count += 1
+    return count
+
+
+# Tracing
+class Trace(object):
+    """ Phase timings and counters of one command. """
+    def __init__(self, form="text"):
+        from timeit import default_timer
+        self.timer = default_timer
+        self.form = form
+        self.phases = {}
+        self.order = []
+        self.counters = {}
+
+    def add(self, phase, seconds):
+        """ add one timed call of phase """
+        if phase not in self.phases:
+            self.phases[phase] = [0.0, 0]
+            self.order.append(phase)
+        self.phases[phase][0] += seconds
+        self.phases[phase][1] += 1
+
+    def count(self, counter, amount=1):
+        """ add amount to counter """
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def wrap(self, function, phase, calls, empty):
+        """ function, timed as phase, counting its calls and the calls that
+        return nothing """
+        def traced(*args):
+            begin = self.timer()
+            result = function(*args)
+            self.add(phase, self.timer() - begin)
+            self.count(calls)
+            if not result:
+                self.count(empty)
+            return result
+        return traced
+
+    def report(self, argv, fdout):
+        """ write the phases and counters as text or as one JSON object """
+        if self.form == "json":
+            import json
+            fdout.write(json.dumps({
+              "command": argv,
+              "phases": dict(
+                (phase, {"seconds": seconds, "calls": calls})
+                for (phase, (seconds, calls)) in self.phases.items()),
+              "counters": self.counters}, sort_keys=True) + "\n")
+            return
+        fdout.write("TRACE %s\n" % (" ".join(argv), ))
+        fdout.write("%-24s %12s %8s\n" % ("phase", "ms", "calls"))
+        for phase in self.order:
+            (seconds, calls) = self.phases[phase]
+            fdout.write("%-24s %12.3f %8d\n" % (phase, seconds * 1000, calls))
+        fdout.write("%-24s %12s\n" % ("counter", "value"))
+        for counter in sorted(self.counters.keys()):
+            fdout.write("%-24s %12d\n" % (counter, self.counters[counter]))
+
+
+class TracePhase(object):
+    """ Context manager that times a phase of the command while tracing,
+    and does nothing otherwise. """
+    def __init__(self, phase):
+        self.phase = phase
+        self.begin = None
+
+    def __enter__(self):
+        if TRACE is not None:
+            self.begin = TRACE.timer()
+        return self
+
+    def __exit__(self, *exc):
+        if TRACE is not None and self.begin is not None:
+            TRACE.add(self.phase, TRACE.timer() - self.begin)
+
+
+def start_trace(form):
+    """ Start tracing, reported as text or json; a form of None or "" does
+    not trace. """
+    global TRACE
+    if form and TRACE is None:
+        TRACE = Trace("json" if form == "json" else "text")
+
+
+def finish_trace(argv, fdout=None):
+    """ report the trace of the command argv on stderr and stop tracing """
+    global TRACE
+    if TRACE is not None:
+        TRACE.report(argv, fdout or sys.stderr)
+    TRACE = None
+
+
+def trace_count(counter, amount=1):
+    """ add amount to counter while tracing """
+    if TRACE is not None:
+        TRACE.count(counter, amount)
+
+
+def traced(function, phase, calls, empty):
+    """ function, wrapped by Trace.wrap while tracing """
+    if TRACE is None:
+        return function
+    return TRACE.wrap(function, phase, calls, empty)
+
+
+# Locking
+def lock_path(timelog=TIMELOG):
+    """ path of the lock file beside the timelog """
+    return getattr(timelog, "timelog", timelog) + LOCK_SUFFIX
+
+
+def thread_ident():
+    """ identity of the calling thread """
+    try:
+        from _thread import get_ident
+    except ImportError:  # Python 2
+        from thread import get_ident
+    return get_ident()
+
+
+class TimelogLock(object):
+    """ Exclusive lock on the lock file beside a timelog, reentrant within a
+    thread. """
+    def __init__(self, timelog=TIMELOG):
+        self.path = None if timelog is None else lock_path(timelog)
+
+    def __enter__(self):
+        if self.path is None:
+            return self
+        self.key = (self.path, thread_ident())
+        held = HELD_LOCKS.get(self.key)
+        if held is not None:
+            held[1] += 1
+            return self
+        try:
+            import fcntl
+        except ImportError:  # e.g. Windows, run unlocked
+            fcntl = None
+        fd = None
+        if fcntl is not None:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        HELD_LOCKS[self.key] = [fd, 1]
+        return self
+
+    def __exit__(self, *exc):
+        if self.path is None:
+            return
+        held = HELD_LOCKS[self.key]
+        held[1] -= 1
+        if held[1] == 0:
+            del HELD_LOCKS[self.key]
+            if held[0] is not None:
+                os.close(held[0])  # releases the lock
+
+
+def write_atomic(path, data):
+    """ Replace the file at path with data through a temporary file. """
+    temporary = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(temporary, "wb") as fdout:
+            fdout.write(data)
+            fdout.flush()
+            os.fsync(fdout.fileno())
+        getattr(os, "replace", os.rename)(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+# Server
+def server_socket_path(timelog=TIMELOG):
+    """ path of the Unix socket a server for timelog listens on """
+    return timelog + SOCKET_SUFFIX
+
+
+def open_server(path):
+    """ listening Unix socket at path, replacing any stale socket file """
+    import socket
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(5)
+    return server
+
+
+def serve(timelog=TIMELOG, path=None):
+    """ Load timelog into memory once and answer start, stop and list
+    requests on a Unix socket until interrupted. """
+    if path is None:
+        path = server_socket_path(timelog)
+    import signal
+    memory = MemoryBackend(get_backend(timelog))
+    server = open_server(path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            handle_request(server, memory)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(path)
+    return
+
+
+def handle_request(server, memory):
+    """ Accept one request and answer it. """
+    import socket
+    (connection, junk) = server.accept()
+    try:
+        connection.settimeout(SERVER_TIMEOUT)
+        request = read_all(connection)
+        connection.sendall(answer_request(request, memory))
+    except (IOError, OSError, socket.error):  # the client went away
+        pass
+    finally:
+        connection.close()
+    return
+
+
+def answer_request(request, memory):
+    """ the reply of handle_request to request """
+    try:
+        words = request.decode("utf-8").split("\0")
+        now = parse_fixed_datetime(words[0][:19]).replace(
+          microsecond=int(words[0][20:]))
+        (command, detail) = (words[1], words[2:])
+    except (AttributeError, IndexError, ValueError):  # bad request
+        return b"0"
+    output = capture_output(run_served_command, command, detail, now, memory)
+    if output is None:
+        return b"0"
+    return b"1" + output.encode("utf-8")
+
+
+def run_served_command(command, detail, now, memory):
+    """ run a command the server answers; False if it is not one """
+    if command not in SERVED_COMMANDS:
+        return False
+    return run_command(command, detail, now, memory)
+
+
+def capture_output(function, *args):
+    """ Call function with stdout captured.  Returns what it printed, or
+    None if it returned False. """
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
+    (stdout, sys.stdout) = (sys.stdout, StringIO())
+    try:
+        if not function(*args):
+            return None
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+
+def read_all(connection):
+    """ read from a socket until the other end stops sending """
+    chunks = []
+    while True:
+        chunk = connection.recv(65536)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def request_server(argv, now, timelog=TIMELOG):
+    """ Ask a running server to run a start, stop or list command; returns
+    False if the caller should run it. """
+    path = server_socket_path(timelog)
+    if not argv or argv[0] not in SERVED_COMMANDS or not os.path.exists(path):
+        return False
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(SERVER_TIMEOUT)
+        client.connect(path)
+    except (IOError, OSError, socket.error):  # no server is running
+        client.close()
+        return False
+    try:
+        reply = exchange_request(client, argv, now)
+    finally:
+        client.close()
+    if reply is None and argv[0] in LOCKED_COMMANDS:
+        sys.exit(
+          "ERROR: the tracktime server did not answer, so %s may or may not"
+          " have been applied" % (argv[0], ))
+    if reply is None or reply[:1] != b"1":
+        return False
+    sys.stdout.write(reply[1:].decode("utf-8"))
+    return True
+
+
+def exchange_request(client, argv, now):
+    """ Send the request for argv at now to the server connected to client
+    and return its reply, or None if there was none. """
+    import socket
+    try:
+        if argv[0] in LOCKED_COMMANDS:
+            client.settimeout(None)  # the server may wait for the lock
+        client.sendall("\0".join(
+          ["%s.%06d" % (datetime_key(now), now.microsecond)] + argv
+          ).encode("utf-8"))
+        client.shutdown(socket.SHUT_WR)
+        reply = read_all(client)
+    except (IOError, OSError, socket.error):  # the server went away
+        return None
+    return reply or None
+
+
+# Watching
+class TimelogTail(object):
+    """ The activities of some days of a timelog, refreshed from what was
+    written since. """
+    def __init__(self, timelog=TIMELOG):
+        self.timelog = timelog
+        self.days = []
+        self.buckets = {}
+        self.stamp = None
+        self.offset = 0
+        self.last = None  # the bucket the last record read went into
+
+    def refresh(self, days):
+        """ Bring the activities of days, in self.buckets, up to date.
+        Returns whether they may have changed since the last refresh. """
+        if not isinstance(get_backend(self.timelog), TextBackend):
+            (self.days, self.buckets) = (days, bucket_rows(days, self.timelog))
+            return True
+        try:
+            stat = os.stat(self.timelog)
+            stamp = (stat.st_ino, stat.st_size, stat.st_mtime)
+        except OSError:  # no timelog yet
+            stamp = None
+        if stamp == self.stamp and days == self.days:
+            return False
+        if (days != self.days or stamp is None or self.stamp is None or
+                stamp[0] != self.stamp[0] or stamp[1] < self.offset):
+            self.reset(days)
+        self.stamp = stamp
+        if stamp is not None:
+            self.read_tail()
+        return True
+
+    def reset(self, days):
+        """ forget what was read, to read again from the first of days """
+        self.days = days
+        self.buckets = dict((day, []) for day in days)
+        self.last = None
+        try:
+            self.offset = find_day_offset(min(days), self.timelog)
+        except (IOError, OSError, ValueError):  # no timelog yet
+            self.offset = 0
+
+    def read_tail(self):
+        """ Parse the complete lines from the last record read to the end of
+        the timelog, leaving a line still being written for later. """
+        if self.last is not None:
+            self.last.pop()
+            self.last = None
+        offset = start = self.offset
+        with open(self.timelog, "rb") as fdin:
+            fdin.seek(offset)
+            trace_count("files opened")
+            for line in fdin:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    activity = parse_line(line.decode("utf-8"), self.timelog)
+                except ValueError:  # malformed line, skip it
+                    activity = None
+                if activity:
+                    (self.offset, self.last) = (offset, self.bucket(activity))
+                    self.last.append(activity)
+                offset += len(line)
+        trace_count("bytes read", offset - start)
+        if self.last is None:
+            self.offset = offset
+
+    def bucket(self, activity):
+        """ the list of activities on the day activity started, or a list
+        that is thrown away for other days """
+        start = activity.starttime
+        return self.buckets.get(
+          datetime.datetime(start.year, start.month, start.day), [])
+
+
+def watch(
+  week=False, timelog=TIMELOG, interval=WATCH_INTERVAL, refreshes=None,
+  clock=datetime.datetime.now):
+    """ Show the activity list as list does, again whenever the timelog
+    changes. """
+    import time
+    tail = TimelogTail(timelog)
+    shown = None
+    count = 0
+    while refreshes is None or count < refreshes:
+        if count:
+            time.sleep(interval)
+        count += 1
+        now = clock()
+        today = datetime.datetime(now.year, now.month, now.day)
+        days = week_days(now) if week else [today]
+        minute = now.replace(second=0, microsecond=0)
+        if not tail.refresh(days) and minute == shown:
+            continue
+        shown = minute
+        if sys.stdout.isatty():
+            sys.stdout.write(WATCH_CLEAR)
+        print_days(days, tail.buckets, now)
+        sys.stdout.flush()
+    return
+
+
 def make_parser():
+    import argparse
+
     class CustomFormatter(
       argparse.ArgumentDefaultsHelpFormatter,
       argparse.RawDescriptionHelpFormatter):
@@ -248,66 +3109,505 @@ def make_parser():
     tracktime stop
             Stops in progress activity
     tracktime list [week]
-            Lists the Activities for the day (default), or weekly summary""",
+            Lists the Activities for the day (default), or weekly summary
+    tracktime list month|year|2016-01-01 2016-03-31
+            Lists the hours per day by category this month, this year, or
+            from one day to another, with category totals.  Add --jobs N
+            to parse a long history with N processes
+    tracktime list --category work --name 'admin*' [week|month|...]
+            Lists only the activities whose category and name match the
+            glob patterns, reading only their lines through the term
+            index kept beside the timelog
+    tracktime watch [week]
+            Keeps the day's (default) or week's activity list on screen,
+            showing it again as the timelog changes; only what was written
+            since is read, polling every --interval seconds
+    tracktime at 2023-03-02T14:30
+            Lists the activities in progress at a moment
+    tracktime overlaps 2023-03-02T14:00 2023-03-02T15:30
+            Lists the activities in progress at any time in a window.  Both
+            mark with ! any activity that overlaps another one, which the
+            totals would count twice
+    tracktime team [week|month|year|FROM TO] alice=~alice/timelog.txt ...
+            Totals the hours by category of each user and of the team in
+            many timelogs, this week by default; each is NAME=PATH or a
+            PATH that names itself
+    tracktime export --format csv|jsonl [week|month|year|FROM TO]
+            Writes the activities, all of them by default, to stdout.
+            Add --jobs N to parse them with N processes first
+    tracktime import [--format csv|jsonl] [history.csv]
+            Appends the activities of a file or of stdin in the layout
+            written by export, after checking that they are in order and
+            do not overlap; the format follows the file extension
+    tracktime batch [backfill.txt]
+            Applies lines of "start 2016-06-09T09:00 Learn Latin@Tiny Office"
+            and "stop 2016-06-09T11:30" from a file or stdin, in time
+            order, as start and stop would, writing them all at once
+    tracktime fsck [--repair]
+            Reports malformed lines, records out of order, ending before
+            they start or overlapping another, and activities left in
+            progress when another started the same day.  --repair
+            rewrites the timelog with them fixed, keeping the original
+            lines as comments
+    tracktime migrate ~/timelog.txt ~/timelog.db
+            Copies every activity from one timelog to another.  Timelogs
+            ending in .db, .sqlite or .sqlite3 are SQLite databases; set
+            TRACKTIME_TIMELOG to use one instead of ~/timelog.txt
+    tracktime serve
+            Keeps the timelog in memory and answers start, stop and list
+            over a Unix socket beside it; other tracktime commands use the
+            server while it runs
+    tracktime compact [~/timelog.d]
+            Splits the timelog into one file per month in a directory,
+            compressing the months before this one; set TRACKTIME_TIMELOG
+            to the directory to use it.  Run again to compress the months
+            closed since""",
       formatter_class=CustomFormatter,
       )
     p.add_argument(
-      'command', metavar='CMD', help='Enter a command: start, stop, or list')
+      'command', metavar='CMD',
+      help='Enter a command: start, stop, list, watch, at, overlaps,'
+      ' team, export, import, batch, fsck, migrate, serve, or compact')
+    p.add_argument(
+      '-j', '--jobs', type=int, default=1, metavar='N',
+      help='parse the timelog with N processes for month, year and range'
+      ' reports and for export')
+    p.add_argument(
+      '-f', '--format', choices=EXPORT_FORMATS, default=None,
+      help='format for export (default csv) and import (default from the'
+      ' file extension)')
+    p.add_argument(
+      '-c', '--category', metavar='PATTERN', default=None,
+      help='list only activities in categories matching a glob pattern')
+    p.add_argument(
+      '--name', metavar='PATTERN', default=None,
+      help='list only activities with names matching a glob pattern, such'
+      ' as \'admin*\'')
+    p.add_argument(
+      '-n', '--interval', type=float, default=WATCH_INTERVAL,
+      metavar='SECONDS', help='seconds between polls of the timelog for'
+      ' watch')
+    p.add_argument(
+      '--repair', action='store_true',
+      help='have fsck rewrite the timelog with its problems fixed')
+    p.add_argument(
+      '--profile', action='store_const', const='text', default=None,
+      help='report phase timings and counters on stderr; setting'
+      ' TRACKTIME_TRACE=text does the same')
+    p.add_argument(
+      '--profile-json', action='store_const', const='json', dest='profile',
+      help='report them as JSON, as TRACKTIME_TRACE=json does')
+    p.add_argument(
+      '--cprofile', metavar='FILE', default=None,
+      help='dump a cProfile of the command to FILE for pstats')
     p.add_argument(
       'detail', nargs='*', metavar='DETAIL',
       help='''REQUIRED for start command: specify activity@category.\n
-      OPTIONAL for list command: specify \'week\' for a weekly summary.''')
+      OPTIONAL for list command: specify \'week\' for a weekly summary,\n
+      \'month\' or \'year\' for a monthly or yearly report, or FROM TO\n
+      days as YYYY-MM-DD.\n
+      OPTIONAL for watch command: specify \'week\' for a weekly summary.\n
+      REQUIRED for team command: specify the timelogs, optionally after\n
+      a report range as for list.\n
+      REQUIRED for at command: specify a time as YYYY-MM-DDTHH:MM[:SS].\n
+      REQUIRED for overlaps command: specify FROM and TO times.\n
+      OPTIONAL for export command: specify a report range as for list.\n
+      OPTIONAL for import command: specify the file to read.\n
+      OPTIONAL for batch command: specify the file to read.\n
+      REQUIRED for migrate command: specify source and destination.\n
+      OPTIONAL for compact command: specify the segment directory.''')
     return p
 
 
 def parse_activity_at_category(p, args):
     """ parse activity@category - split at last '@' sign """
     try:
-        if len(args.detail) > 1:
-            activity = ' '.join(args.detail)
-        else:
-            activity = args.detail[0]
-        if activity.rfind("@") > 1:
-            (activity, category) = activity.rsplit("@", 1)
-            activity = activity.strip()
-            category = category.strip()
-            if category == "":
-                category = DEFAULT_CATEGORY
-        else:
-            category = DEFAULT_CATEGORY
+        (activity, category) = split_activity_at_category(args.detail)
     except (IndexError, NameError):
         p.error("ERROR: start command missing activity name")
     return activity, category
 
 
+def split_activity_at_category(detail):
+    """ split the words of activity@category at the last '@' sign """
+    if len(detail) > 1:
+        activity = ' '.join(detail)
+    else:
+        activity = detail[0]
+    if activity.rfind("@") > 1:
+        (activity, category) = activity.rsplit("@", 1)
+        activity = activity.strip()
+        category = category.strip()
+        if category == "":
+            category = DEFAULT_CATEGORY
+    else:
+        category = DEFAULT_CATEGORY
+    return activity, category
+
+
+class Options(object):
+    """ Options from the command line, with the defaults used when a
+    command has none """
+    jobs = 1
+    format = None
+    profile = None
+    cprofile = None
+    interval = WATCH_INTERVAL
+    category = None
+    name = None
+    repair = False
+
+    def __init__(self, **options):
+        self.__dict__.update(options)
+
+
+DEFAULT_OPTIONS = Options()
+
+
+def command_start(detail, now, timelog=TIMELOG, options=DEFAULT_OPTIONS):
+    """ start activity@category """
+    if len(detail) == 0:
+        return False
+    (activity, category) = split_activity_at_category(detail)
+    print("STARTING", "TASK: ", activity, "TAG: ", category)
+    start(now, activity, category, timelog)
+    return True
+
+
+def command_stop(detail, now, timelog=TIMELOG, options=DEFAULT_OPTIONS):
+    """ stop the activity in progress """
+    if len(detail) != 0:
+        return False
+    print("STOPPING CURRENT TASK")
+    stop(now, timelog)
+    return True
+
+
+def command_list(detail, now, timelog=TIMELOG, options=DEFAULT_OPTIONS):
+    """ list today, this week, month or year, or the days FROM TO """
+    report = report_range(detail, now)
+    (category, name) = (options.category, options.name)
+    if detail == ["week"]:
+        list_week(now, timelog, category, name)
+    elif report is not None:
+        list_range(
+          report[0], report[1], now, timelog, options.jobs, category, name)
+    elif len(detail) == 0:
+        list_day(
+          datetime.datetime(now.year, now.month, now.day), now, timelog, True,
+          category, name)
+    else:
+        return False
+    return True
+
+
+def command_watch(detail, now, timelog=TIMELOG, options=DEFAULT_OPTIONS):
+    """ keep today's or this week's activity list on screen """
+    if detail not in ([], ["week"]) or options.interval <= 0:
+        return False
+    try:
+        watch(detail == ["week"], timelog, options.interval)
+    except KeyboardInterrupt:
+        pass
+    return True
+
+
+def command_team(detail, now, timelog=TIMELOG, options=DEFAULT_OPTIONS):
+    """ total the hours in many users' timelogs, given as [NAME=]PATH, this
+    week (default), month or year, or the days FROM TO """
+    (first_day, end_day, words) = split_report_range(detail, now)
+    timelogs = [
+      tuple(word.split("=", 1)) if "=" in word else (word, word)
+      for word in words]
+    if not timelogs or not all(
+      os.path.exists(path) for (name, path) in timelogs):
+        return False
+    team(timelogs, first_day, end_day, now)
+    return True
+
+
+def report_range(detail, now):
+    """ (first_day, end_day) of this week, month or year, or the days FROM TO;
+    None for anything else """
+    today = datetime.datetime(now.year, now.month, now.day)
+    tomorrow = today + datetime.timedelta(days=1)
+    if detail == ["week"]:
+        first_day = today - datetime.timedelta(now.weekday() + 1)
+        return first_day, min(first_day + datetime.timedelta(days=7), tomorrow)
+    if detail == ["month"]:
+        return today.replace(day=1), tomorrow
+    if detail == ["year"]:
+        return today.replace(month=1, day=1), tomorrow
+    if len(detail) != 2:
+        return None
+    try:
+        (first_day, last_day) = [
+          datetime.datetime.strptime(day, DAYFORMAT) for day in detail]
+    except ValueError:  # not YYYY-MM-DD
+        return None
+    if last_day < first_day:
+        return None
+    return first_day, last_day + datetime.timedelta(days=1)
+
+
+def split_report_range(detail, now):
+    """ Split a leading report range off detail, as (first_day, end_day,
+    the remaining words).  The range defaults to this week. """
+    for count in (2, 1):
+        report = report_range(detail[:count], now)
+        if report is not None:
+            return report + (detail[count:], )
+    return report_range(["week"], now) + (detail, )
+
+
+def command_serve(detail, now, timelog=TIMELOG, options=DEFAULT_OPTIONS):
+    """ serve the timelog from memory on a Unix socket """
+    if len(detail) != 0:
+        return False
+    print("SERVING %s ON %s" % (timelog, server_socket_path(timelog)))
+    sys.stdout.flush()
+    serve(timelog)
+    return True
+
+
+def command_compact(detail, now, timelog=TIMELOG, options=DEFAULT_OPTIONS):
+    """ split the timelog into compressed monthly segments """
+    if len(detail) > 1:
+        return False
+    if detail:
+        destination = detail[0]
+    else:
+        destination = os.path.splitext(timelog)[0] + SEGMENTS_SUFFIX
+    if not os.path.isdir(timelog) and os.path.exists(destination) and (
+      not os.path.isdir(destination) or os.listdir(destination)):
+        return False
+    (count, compressed) = compact(timelog, destination, now)
+    if not os.path.isdir(timelog):
+        print("COMPACTED %d ACTIVITIES INTO %s" % (count, destination))
+    print("COMPRESSED %d SEGMENTS" % compressed)
+    return True
+
+
+def command_fsck(detail, now, timelog=TIMELOG, options=DEFAULT_OPTIONS):
+    """ check a text timelog for problems, and fix them with --repair """
+    if detail or not os.path.isfile(timelog) or (
+      not isinstance(get_backend(timelog), TextBackend)):
+        return False
+    checker = TimelogChecker()
+    problems = 0
+    for (number, problem) in check_timelog(timelog, checker):
+        print("line %d: %s" % (number, problem))
+        problems += 1
+    print("CHECKED %d LINES OF %s, %d PROBLEMS" % (
+      checker.lines, timelog, problems))
+    if problems and options.repair:
+        print("REPAIRED %d LINES, KEEPING THE ORIGINALS AS # fsck COMMENTS" % (
+          repair_timelog(timelog), ))
+    elif problems:
+        sys.exit("ERROR: %s has problems; tracktime fsck --repair fixes them"
+                 % (timelog, ))
+    return True
+
+
+def command_at(detail, now, timelog=TIMELOG, options=DEFAULT_OPTIONS):
+    """ list the activities in progress at a moment """
+    moment = parse_timestamp(detail) if 0 < len(detail) < 3 else None
+    if moment is None:
+        return False
+    at(moment, now, timelog)
+    return True
+
+
+def command_overlaps(
+  detail, now, timelog=TIMELOG, options=DEFAULT_OPTIONS):
+    """ list the activities in progress during a window FROM TO """
+    if len(detail) != 2:
+        return False
+    (first, end) = (parse_timestamp(detail[:1]), parse_timestamp(detail[1:]))
+    if first is None or end is None or end <= first:
+        return False
+    overlaps(first, end, now, timelog)
+    return True
+
+
+def command_export(detail, now, timelog=TIMELOG, options=DEFAULT_OPTIONS):
+    """ write activities to stdout as csv or jsonl, all of them or those in
+    a report range """
+    report = (FIRST_DAY, LAST_DAY)
+    if detail:
+        report = report_range(detail, now)
+    if report is None:
+        return False
+    export(
+      report[0], report[1], options.format or "csv", timelog,
+      jobs=options.jobs)
+    return True
+
+
+def command_import(detail, now, timelog=TIMELOG, options=DEFAULT_OPTIONS):
+    """ append the csv or jsonl activities of a file, or of stdin """
+    if len(detail) > 1:
+        return False
+    path = detail[0] if detail else "-"
+    form = options.format
+    if form is None:
+        form = "jsonl" if path.endswith((".jsonl", ".json")) else "csv"
+    fdin = open_input(path, "nothing imported")
+    try:
+        with fdin:
+            count = import_activities(
+              (read_csv if form == "csv" else read_jsonl)(fdin), timelog)
+    except ValueError as error:
+        sys.exit("ERROR: nothing imported, %s" % (error, ))
+    print("IMPORTED %d ACTIVITIES" % count)
+    return True
+
+
+def open_input(path, failure):
+    """ the file at path opened for reading, or stdin if path is "-";
+    exits with an error starting with failure if it cannot be opened """
+    if path == "-":
+        return sys.stdin
+    try:
+        return open(path)
+    except (IOError, OSError) as error:
+        sys.exit("ERROR: %s, cannot read %s: %s" % (
+          failure, path, error.strerror))
+
+
+def command_batch(detail, now, timelog=TIMELOG, options=DEFAULT_OPTIONS):
+    """ apply the start and stop commands of a file, or of stdin """
+    if len(detail) > 1:
+        return False
+    path = detail[0] if detail else "-"
+    fdin = open_input(path, "nothing applied")
+    try:
+        with fdin:
+            (count, appended) = batch(fdin, timelog)
+    except ValueError as error:
+        sys.exit("ERROR: nothing applied, %s" % (error, ))
+    print("APPLIED %d COMMANDS, APPENDING %d ACTIVITIES" % (count, appended))
+    return True
+
+
+def command_migrate(detail, now, timelog=TIMELOG, options=DEFAULT_OPTIONS):
+    """ copy every activity from one timelog to another """
+    if len(detail) != 2:
+        return False
+    count = migrate(detail[0], detail[1])
+    print("MIGRATED %d ACTIVITIES" % count)
+    return True
+
+
+COMMANDS = {
+  "start": command_start,
+  "stop": command_stop,
+  "list": command_list,
+  "migrate": command_migrate,
+  "serve": command_serve,
+  "compact": command_compact,
+  "team": command_team,
+  "watch": command_watch,
+  "at": command_at,
+  "overlaps": command_overlaps,
+  "export": command_export,
+  "import": command_import,
+  "fsck": command_fsck,
+  "batch": command_batch,
+  }
+COMMAND_ERRORS = {
+  "start": "ERROR: start command missing activity name",
+  "migrate": "ERROR: migrate needs a source and a destination",
+  "compact": "ERROR: compact needs a new or empty destination directory",
+  "team": "ERROR: team needs the paths of timelogs that exist",
+  "watch": "ERROR: watch takes week or nothing, and a positive --interval",
+  "at": "ERROR: at needs a time as YYYY-MM-DDTHH:MM[:SS]",
+  "overlaps": "ERROR: overlaps needs FROM and TO times as"
+              " YYYY-MM-DDTHH:MM[:SS] or YYYY-MM-DD, FROM first",
+  "export": "ERROR: export takes week, month, year or FROM TO",
+  "import": "ERROR: import takes one file, or reads stdin",
+  "fsck": "ERROR: fsck takes no detail, and checks a text timelog",
+  "batch": "ERROR: batch takes one file, or reads stdin",
+  }
+
+
+def run_command(
+  command, detail, now, timelog=TIMELOG, options=DEFAULT_OPTIONS):
+    """ Run command with its detail words and options.  Returns False if
+    the command or its detail is not recognized. """
+    if command not in COMMANDS:
+        return False
+    return COMMANDS[command](detail, now, timelog, options)
+
+
+def run_locked_command(
+  command, detail, timelog=TIMELOG, options=DEFAULT_OPTIONS):
+    """ run_command, reading the clock once the timelog is locked for start and
+    stop """
+    locked = locks_timelog(command, detail)
+    with TimelogLock(timelog if locked else None):
+        with TracePhase("command"):
+            return run_command(
+              command, detail, datetime.datetime.now(), timelog, options)
+
+
+def locks_timelog(command, detail):
+    """ True if command changes the timelog and detail is valid for it """
+    if command == "start":
+        return len(detail) != 0
+    return command == "stop" and len(detail) == 0
+
+
+def run_profiled_command(
+  command, detail, timelog=TIMELOG, options=DEFAULT_OPTIONS):
+    """ Run command as run_locked_command does, under cProfile with the
+    stats dumped to options.cprofile if it is set. """
+    if not options.cprofile:
+        return run_locked_command(command, detail, timelog, options)
+    import cProfile
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(
+          run_locked_command, command, detail, timelog, options)
+    finally:
+        profile.dump_stats(options.cprofile)
+
+
 def main(argv=None):
     """ Check syntax of argv and perform requested action """
+    if argv is None:
+        argv = sys.argv[1:]
+    start_trace(os.environ.get("TRACKTIME_TRACE"))
+    try:
+        run_main(argv)
+    finally:
+        finish_trace(argv)
+
+
+def run_main(argv):
+    """ main, once tracing is set up """
     timelog = TIMELOG
-    now = datetime.datetime.now()
+    if argv and not [arg for arg in argv if arg.startswith("-")]:
+        if TRACE is None and request_server(
+          argv, datetime.datetime.now(), timelog):
+            return
+        if run_locked_command(argv[0], argv[1:], timelog):
+            return
     p = make_parser()
-    args = p.parse_args()
-    if args.command == "start":
-        (activity, category) = parse_activity_at_category(p, args)
-        print("STARTING", "TASK: ", activity, "TAG: ", category)
-        start(now, activity, category)
-    elif args.command == "stop":
-        if len(args.detail) == 0:
-            print("STOPPING CURRENT TASK")
-            stop(now, timelog)
-        else:
-            p.error("ERROR: bad option for %s command" % args.command)
-    elif args.command == "list":
-        if len(args.detail) == 1 and args.detail[0] == "week":
-            list_week(now)
-        elif len(args.detail) == 0:
-            today = datetime.datetime(now.year, now.month, now.day)
-            list_day(today, now)
-        else:
-            p.error("ERROR: bad option for %s command" % args.command)
+    # options may come between the details, as in list --category work week
+    parse = getattr(p, "parse_intermixed_args", p.parse_args)
+    args = parse(argv, namespace=Options())
+    start_trace(args.profile)
+    if run_profiled_command(args.command, args.detail, timelog, args):
+        return
+    if args.command in COMMAND_ERRORS:
+        p.error(COMMAND_ERRORS[args.command])
+    elif args.command in COMMANDS:
+        p.error("ERROR: bad option for %s command" % args.command)
     else:
         p.error("ERROR: unrecognzed command")
     return
 
 
 if __name__ == "__main__":
-    main(argv)
+    main(sys.argv[1:])